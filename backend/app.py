@@ -58,15 +58,18 @@ def message(data):
 def connect():
     print("sending queue")
     controller: Controller = controllers["Bedroom"]
-    queue = controller.queue_state.get_queue_dict()
-    emit("message", {"data": json.dumps(queue)})
+    messages = asyncio.run_coroutine_threadsafe(
+        controller.queue_state.get_messages(), loop
+    ).result()
+    for message in messages:
+        emit("message", {"data": json.dumps(message)})
 
 
 # TODO: make an abc and use it to define the variants
 # shouldn't keep 2 names
 class WebSockets:
-    def send_queue(self, queue: dict):
-        socketio.emit("message", {"data": json.dumps(queue)})
+    def send_message(self, message: dict):
+        socketio.emit("message", {"data": json.dumps(message)})
 
     def clean_up(self):
         pass
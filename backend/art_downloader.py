@@ -1,56 +1,157 @@
 """Download art from using the very slow sonos album art uris"""
 
 from __future__ import annotations
+import asyncio
+import hashlib
 import os
 from typing import TYPE_CHECKING
+from urllib.parse import urlsplit
+
+import aiohttp
+
+import metrics
 
 
 if TYPE_CHECKING:
     from backend.sonos import AlbumArtDownload
     from aiohttp import ClientSession
-    from queued_executors import QueuedAsyncExecutor
-    from typing import Callable, Iterable
+    from art_index import ArtIndex
+    from typing import Awaitable, Callable, Iterable, Optional
+
+
+# downloads run at once against a single speaker and across all speakers
+HOST_CONCURRENCY = 2
+GLOBAL_CONCURRENCY = 8
+# seconds
+DOWNLOAD_TIMEOUT = 15
+RETRY_BACKOFF = 0.5
+DOWNLOAD_RETRIES = 3
 
 
 class ArtDownloader:
     """Downloads art for speaker queues
-    io on the sonos is quite slow so this is done concurrently using
-    async
+    io on the sonos is quite slow so downloads are run concurrently,
+    limited per speaker so that a speaker isn't swamped. One downloader
+    is shared by all the speakers so art that's queued on several 
+    speakers is only downloaded once
     """
     def __init__(
-        self, 
+        self,
         client_session: ClientSession,
-        queue: QueuedAsyncExecutor,
+        art_index: ArtIndex,
+        host_concurrency: int = HOST_CONCURRENCY,
+        global_concurrency: int = GLOBAL_CONCURRENCY,
+        timeout: float = DOWNLOAD_TIMEOUT,
+        retries: int = DOWNLOAD_RETRIES,
+        post_download: Optional[Callable[[str], Awaitable[None]]] = None,
     ) -> None:
-        
+
         self.client_session = client_session
-        self.queue = queue 
+        self._art_index = art_index
+        self._host_concurrency = host_concurrency
+        self._host_limits: dict[str, asyncio.Semaphore] = {}
+        self._global_limit = asyncio.Semaphore(global_concurrency)
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._retries = retries
+        self._post_download = post_download
+        # downloads in progress and who to tell when they finish, keyed
+        # by server_uri
+        self._in_flight: dict[str, asyncio.Task] = {}
+        self._callbacks: dict[str, list[Callable[[str], None]]] = {}
 
     async def clean_up(self) -> None:
+        for task in list(self._in_flight.values()):
+            task.cancel()
         await self.client_session.close()
-        
-    async def _download_art_to_server(self, album: 'AlbumArtDownload') -> None:
+
+    def _host_limit(self, uri: str) -> asyncio.Semaphore:
+        host = urlsplit(uri).netloc
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(
+                self._host_concurrency
+            )
+        return self._host_limits[host]
+
+    async def _download_art_to_server(self, album: AlbumArtDownload) -> str:
+        """Downloads to a temporary file that's moved into the store once
+        complete so that a partial download never appears in the cache,
+        returns the path of the stored image
+        """
+        temp_path = self._art_index.temp_path()
+        digest = hashlib.sha256()
         try:
             print("downloading: ",album.sonos_uri)
-            async with self.client_session.get(album.sonos_uri) as response:
-                with open(album.server_uri, "wb") as f:
+            async with self.client_session.get(
+                album.sonos_uri, timeout=self._timeout
+            ) as response:
+                response.raise_for_status()
+                with open(temp_path, "wb") as f:
                     async for data in response.content.iter_any():
+                        digest.update(data)
                         f.write(data)
-        except ValueError:
-            os.remove(album.server_uri)
-    
-    async def command(self, album, callback_art_downloaded) -> None:
-        if not os.path.isfile(album.server_uri):
-            await self._download_art_to_server(album)
-            callback_art_downloaded(album.server_uri)
+                        metrics.ART_DOWNLOAD_BYTES.inc(len(data))
+        except BaseException:
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
+            raise
+        return self._art_index.add(
+            album.server_uri, temp_path, digest.hexdigest()
+        )
 
-    def enqueue_art(
+    async def _download_with_retries(
         self, 
-        album_art_downloads: Iterable[AlbumArtDownload], 
+        album: AlbumArtDownload,
+    ) -> Optional[str]:
+        host_limit = self._host_limit(album.sonos_uri)
+        for attempt in range(self._retries + 1):
+            try:
+                # wait on the speaker first so a busy speaker doesn't
+                # hold global slots that others could be using
+                async with host_limit, self._global_limit:
+                    return await self._download_art_to_server(album)
+            except ValueError:
+                # not a valid uri, no point retrying
+                return None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self._retries:
+                    print("failed to download: ", album.sonos_uri, repr(e))
+                    return None
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+        return None
+
+    async def command(self, album: AlbumArtDownload) -> None:
+        try:
+            # e.g. downloaded for another speaker since the queue was read
+            downloaded = self._art_index.available(album.server_uri)
+            if downloaded:
+                metrics.ART_DOWNLOADS.inc(result="cached")
+            else:
+                path = await self._download_with_retries(album)
+                downloaded = path is not None
+                metrics.ART_DOWNLOADS.inc(
+                    result="downloaded" if downloaded else "failed"
+                )
+                if downloaded and self._post_download is not None:
+                    await self._post_download(path)
+        finally:
+            del self._in_flight[album.server_uri]
+            callbacks = self._callbacks.pop(album.server_uri)
+        if downloaded:
+            for callback_art_downloaded in callbacks:
+                callback_art_downloaded(album.server_uri)
+
+    def enqueue_art(
+        self,
+        album_art_downloads: Iterable[AlbumArtDownload],
         callback_art_downloaded: Callable[[str], None]
     ) -> None:
+        # the semaphores are first in first out so art is downloaded in
+        # the order it's enqueued
         for album in album_art_downloads:
-            self.queue.put_nowait(
-                self.command, album, callback_art_downloaded
-            )
-        
\ No newline at end of file
+            callbacks = self._callbacks.setdefault(album.server_uri, [])
+            if callback_art_downloaded not in callbacks:
+                callbacks.append(callback_art_downloaded)
+            if album.server_uri not in self._in_flight:
+                self._in_flight[album.server_uri] = asyncio.create_task(
+                    self.command(album)
+                )
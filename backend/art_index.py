@@ -0,0 +1,216 @@
+"""Keeps track of which album art is in the cache without touching the
+filesystem for each queue item
+
+Art is stored by the hash of its content so the same image (e.g. on
+compilations) is only stored once. Albums are mapped to the images by
+an alias table and the least recently used images are removed once the
+store grows past a size limit. Art in the queues that are being shown is
+never removed, the clients have been told it's available.
+"""
+
+from __future__ import annotations
+import asyncio
+from collections import OrderedDict
+from functools import lru_cache
+import hashlib
+import json
+import os
+import string
+from typing import TYPE_CHECKING
+import uuid
+
+
+if TYPE_CHECKING:
+    from typing import Callable, Iterable, Optional
+
+
+ART_FOLDER = "cache"
+STORE_FOLDER = "cache/art"
+STORE_INDEX = "index.json"
+# bytes
+MAX_STORE_SIZE = 200 * 1024 * 1024
+# seconds to wait for more changes before the index is written
+SAVE_DELAY = 5
+
+_ASCII_LETTERS = frozenset(string.ascii_letters)
+
+_IMAGE_SIGNATURES = (
+    (b"\x89PNG", "png"),
+    (b"\xff\xd8", "jpg"),
+    (b"GIF8", "gif"),
+    (b"RIFF", "webp"),
+)
+
+
+def _a_z_only(s: str) -> str:
+    return "".join(c for c in s if c in _ASCII_LETTERS)
+
+
+@lru_cache(maxsize=4096)
+def art_path(artist: str, album: str) -> str:
+    """The uri that the art for an album is served from. The readable
+    part can collide once punctuation and accents are removed so a hash
+    of the full names is added. The same artists and albums appear many
+    times in a queue so this is memoized
+    """
+    names = f"{artist}\0{album}".encode("utf-8")
+    digest = hashlib.sha1(names).hexdigest()[:10]
+    return f"{ART_FOLDER}/{_a_z_only(artist)}___{_a_z_only(album)}_{digest}"
+
+
+def remove_old_art(folder: str = ART_FOLDER) -> None:
+    """Art used to be stored straight in the cache folder by album name"""
+    if not os.path.isdir(folder):
+        return
+    for entry in os.scandir(folder):
+        if entry.is_file() and entry.name.endswith((".png", ".part")):
+            os.remove(entry.path)
+
+
+def _alias(server_uri: str) -> str:
+    return server_uri.rsplit("/", 1)[-1]
+
+
+def _image_extension(head: bytes) -> str:
+    for signature, extension in _IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return extension
+    return "img"
+
+
+class ArtIndex:
+    """The store is checked once at startup, after that the index is
+    updated as downloads finish
+    """
+
+    def __init__(
+        self,
+        folder: str = STORE_FOLDER,
+        max_size: int = MAX_STORE_SIZE,
+        on_evict: Optional[Callable[[str], None]] = None,
+    ) -> None:
+
+        os.makedirs(folder, exist_ok=True)
+        self._folder = folder
+        self._max_size = max_size
+        self._on_evict = on_evict
+        # server uris of the art in the current queues, replaced once 
+        # the controllers have been set up
+        self.in_use: Callable[[], Iterable[str]] = lambda: ()
+        # image file name -> size, least recently used first
+        self._images: OrderedDict[str, int] = OrderedDict()
+        # album alias -> image file name
+        self._aliases: dict[str, str] = {}
+        self._size = 0
+        self._save_handle: Optional[asyncio.TimerHandle] = None
+        self._load()
+
+    def _load(self) -> None:
+        """Reads the index and removes anything that's inconsistent with
+        it, e.g. partial downloads and images that nothing points to
+        """
+        try:
+            with open(os.path.join(self._folder, STORE_INDEX), "r") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {"images": [], "aliases": {}}
+
+        on_disk = {
+            entry.name: entry.stat().st_size
+            for entry in os.scandir(self._folder)
+            if entry.is_file() and entry.name != STORE_INDEX
+        }
+        for name, _ in index["images"]:
+            if name in on_disk:
+                self._images[name] = on_disk.pop(name)
+        self._aliases = {
+            alias: name
+            for alias, name in index["aliases"].items()
+            if name in self._images
+        }
+        referenced = set(self._aliases.values())
+        for name in list(self._images):
+            if name not in referenced:
+                on_disk[name] = self._images.pop(name)
+        for name in on_disk:
+            os.remove(os.path.join(self._folder, name))
+        self._size = sum(self._images.values())
+        self._evict()
+
+    def image_paths(self) -> set[str]:
+        return {os.path.join(self._folder, name) for name in self._images}
+
+    def available(self, server_uri: str) -> bool:
+        return _alias(server_uri) in self._aliases
+
+    def path(self, server_uri: str) -> Optional[str]:
+        """Where the image for an album is stored, also marks the image
+        as recently used
+        """
+        name = self._aliases.get(_alias(server_uri))
+        if name is None:
+            return None
+        self._images.move_to_end(name)
+        return os.path.join(self._folder, name)
+
+    def temp_path(self) -> str:
+        return os.path.join(self._folder, f"{uuid.uuid4().hex}.part")
+
+    def add(self, server_uri: str, temp_path: str, digest: str) -> str:
+        """Moves a completed download into the store, returns the path
+        of the stored image
+        """
+        with open(temp_path, "rb") as f:
+            name = f"{digest}.{_image_extension(f.read(16))}"
+        path = os.path.join(self._folder, name)
+        if name in self._images:
+            os.remove(temp_path)
+            self._images.move_to_end(name)
+        else:
+            os.replace(temp_path, path)
+            self._images[name] = os.path.getsize(path)
+            self._size += self._images[name]
+        self._aliases[_alias(server_uri)] = name
+        self._evict()
+        self._schedule_save()
+        return path
+
+    def _evict(self) -> None:
+        if self._size <= self._max_size:
+            return
+        in_use = {self._aliases.get(_alias(uri)) for uri in self.in_use()}
+        for name in [n for n in self._images if n not in in_use]:
+            if self._size <= self._max_size or len(self._images) <= 1:
+                break
+            self._size -= self._images.pop(name)
+            self._aliases = {
+                alias: image
+                for alias, image in self._aliases.items()
+                if image != name
+            }
+            path = os.path.join(self._folder, name)
+            os.remove(path)
+            if self._on_evict is not None:
+                self._on_evict(path)
+
+    def _schedule_save(self) -> None:
+        if self._save_handle is None:
+            loop = asyncio.get_event_loop()
+            self._save_handle = loop.call_later(SAVE_DELAY, self.save)
+
+    def save(self) -> None:
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+        index = {
+            "images": list(self._images.items()),
+            "aliases": self._aliases,
+        }
+        path = os.path.join(self._folder, STORE_INDEX)
+        with open(path + ".tmp", "w") as f:
+            json.dump(index, f, separators=(",", ":"))
+        os.replace(path + ".tmp", path)
+
+    async def clean_up(self) -> None:
+        # saves the order the images were last used in
+        self.save()
@@ -0,0 +1,162 @@
+"""Fan out messages to websockets, encoding each message only once
+
+Each websocket has its own bounded outbox so one slow client can't hold
+up the others. Only the latest state matters to the clients so a frame
+replaces any unsent frame with the same key.
+"""
+
+from __future__ import annotations
+import asyncio
+from collections import OrderedDict
+from itertools import count
+import time
+
+from typing import TYPE_CHECKING
+
+from encoding import JSON, EncodedMessage
+import tracing
+
+if TYPE_CHECKING:
+    from aiohttp import web
+    from typing import Hashable, Optional, Union
+
+
+# frames waiting for one websocket before it's considered too slow
+OUTBOX_SIZE = 32
+
+# only the latest of these message types matters to a client
+SUPERSEDING_TYPES = frozenset(("transport", "queue"))
+
+# permessage-deflate window bits, 9-15, for websockets that negotiated
+# compression. Smaller windows use less memory but compress less, None
+# uses the window agreed with the client. Never more than the agreed
+# window and websockets without compression are sent uncompressed frames.
+# Setting it makes aiohttp compress each frame with a new compressor, so
+# frames can't refer back to earlier ones and similar queue pages
+# compress worse than with the agreed window
+COMPRESS_WINDOW_BITS: Optional[int] = None
+
+
+def client_command_id(client_id: str, command_id: str) -> str:
+    """Clients number their own commands, the server prefixes the ids
+    with the client's so they're unique across the clients
+    """
+    return f"{client_id}.{command_id}"
+
+
+def split_command_id(command_id: str) -> tuple[str, str]:
+    """The client's id and the client's own id for the command"""
+    client_id, _, client_command = command_id.partition(".")
+    return client_id, client_command
+
+
+class Frame:
+    """A message shared between every websocket, encoded once for each
+    encoding the websockets use. Kept frames are never superseded
+    """
+    __slots__ = ("key", "message", "trace_id", "created")
+
+    def __init__(self, message: dict, keep: bool = False) -> None:
+        # so the time to reach each websocket can be traced
+        self.trace_id: Optional[str] = tracing.current()
+        self.created = time.monotonic()
+        message_type = message.get("type")
+        self.key: Optional[Hashable] = (
+            message_type 
+            if message_type in SUPERSEDING_TYPES and not keep
+            else None
+        )
+        if not isinstance(message, EncodedMessage):
+            message = EncodedMessage(message)
+        self.message: EncodedMessage = message
+
+    def encoded(self, encoding: str = JSON) -> Union[str, bytes]:
+        return self.message.encoded(encoding)
+
+
+class Outbox:
+    """Sends frames to a single websocket in order, dropping frames
+    that have been superseded before they were sent
+    """
+    _unique_keys = count()
+
+    def __init__(
+        self,
+        websocket: web.WebSocketResponse,
+        max_size: int = OUTBOX_SIZE,
+        encoding: str = JSON,
+        compress_window_bits: Optional[int] = COMPRESS_WINDOW_BITS,
+    ) -> None:
+
+        self.websocket = websocket
+        self.encoding = encoding
+        # aiohttp compresses any frame sent with compress set, whether
+        # or not the client agreed to it
+        negotiated = websocket.compress
+        self._compress: Optional[int] = (
+            min(compress_window_bits, negotiated)
+            if negotiated and compress_window_bits is not None
+            else None
+        )
+        self._max_size = max_size
+        self._frames: OrderedDict[Hashable, Frame] = OrderedDict()
+        self._frame_available = asyncio.Event()
+        self._task: Optional[asyncio.Task] = asyncio.create_task(
+            self._run()
+        )
+
+    @property
+    def closed(self) -> bool:
+        return self._task is None
+
+    def put(self, frame: Frame) -> bool:
+        """Queues the frame, returns False if the websocket has fallen
+        too far behind and has been disconnected
+        """
+        if self.closed:
+            return False
+
+        key = frame.key
+        if key is None:
+            key = ("unique", next(self._unique_keys))
+        # move superseded frames to the back so order is preserved
+        self._frames.pop(key, None)
+        self._frames[key] = frame
+
+        if len(self._frames) > self._max_size:
+            self.close()
+            return False
+
+        self._frame_available.set()
+        return True
+
+    async def _run(self) -> None:
+        while True:
+            await self._frame_available.wait()
+            while self._frames:
+                _, frame = self._frames.popitem(last=False)
+                data = frame.encoded(self.encoding)
+                try:
+                    if isinstance(data, bytes):
+                        await self.websocket.send_bytes(
+                            data, compress=self._compress
+                        )
+                    else:
+                        await self.websocket.send_str(
+                            data, compress=self._compress
+                        )
+                except ConnectionResetError:
+                    self.close()
+                    return
+                tracing.record(
+                    "websocket.send", frame.trace_id, frame.created
+                )
+            self._frame_available.clear()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self._frames.clear()
+        self._task.cancel()
+        self._task = None
+        asyncio.create_task(self.websocket.close())
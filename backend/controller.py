@@ -1,16 +1,31 @@
 from __future__ import annotations
 import asyncio
+from functools import partial
 import re
-from typing import Awaitable, Callable, NamedTuple, TYPE_CHECKING
+from typing import (
+    Awaitable, Callable, Iterable, NamedTuple, Optional, TYPE_CHECKING
+)
 
 from aiohttp import ClientSession
 import soco
 
+from art_index import ArtIndex, remove_old_art
+from snapshots import QueueSnapshots
+from thumbnails import Thumbnails
 from sonos import SonosQueueState
-from events import SocoEventHandler
+from events import (
+    QueueUpdateEventHandler,
+    SocoEventHandler,
+    ZoneGroupTopologyEventHandler,
+)
 from art_downloader import ArtDownloader
 from playback import PlaybackController, playback_controller_queues_empty
-from queued_executors import QueuedAsyncExecutor, LastInQueuedThreadExecutor
+from playlists import PlaylistCatalog
+from queued_executors import (
+    DeviceExecutor,
+    LastInQueuedThreadExecutor, 
+    SingleFlightThreadExecutor,
+)
 
 
 if TYPE_CHECKING:
@@ -18,21 +33,48 @@ if TYPE_CHECKING:
     from soco.core import SoCo
 
 
-def init_art_downloader() -> ArtDownloader:
+# seconds
+DISCOVERY_TIMEOUT = 5
+CONTROLLER_INIT_TIMEOUT = 10
+REDISCOVERY_INTERVAL = 60
+# topology events come from every coordinator and in bursts while
+# speakers are grouped, the groups are read once they've settled
+REGROUP_DELAY = 1
+# a speaker is removed once it's been missing from this many discoveries
+# in a row
+MISSED_DISCOVERIES = 2
+
+
+def init_art_downloader(
+    art_index: ArtIndex, 
+    thumbnails: Thumbnails,
+) -> ArtDownloader:
     client_session = ClientSession()
-    queue: QueuedAsyncExecutor = QueuedAsyncExecutor()
-    return ArtDownloader(client_session, queue)
+    return ArtDownloader(
+        client_session, art_index, post_download=thumbnails.make
+    )
 
 
 def init_playback_controller(
-    device: SoCo
+    device: SoCo,
+    art_index: ArtIndex,
+    executor: DeviceExecutor,
 ) -> tuple[PlaybackController, Callable[[], bool]]:
 
-    play_pause_queue = LastInQueuedThreadExecutor()
-    play_index_queue = LastInQueuedThreadExecutor()
+    play_pause_queue = LastInQueuedThreadExecutor(executor)
+    play_index_queue = LastInQueuedThreadExecutor(executor)
+    queue_fetches = SingleFlightThreadExecutor(executor)
+    playlists = PlaylistCatalog(
+        partial(queue_fetches.run, "playlists", device.get_sonos_playlists)
+    )
     return (
         PlaybackController(
-            device, play_pause_queue, play_index_queue
+            device, 
+            play_pause_queue, 
+            play_index_queue, 
+            queue_fetches, 
+            art_index,
+            playlists,
         ),
         playback_controller_queues_empty(
             play_pause_queue, play_index_queue
@@ -40,18 +82,69 @@ def init_playback_controller(
     )
 
 
+async def init_queue_update_handler(
+    device: SoCo,
+    controller: SonosQueueState, 
+) -> Optional[QueueUpdateEventHandler]:
+    """Returns None if the device won't provide queue update ids, queue 
+    changes are then inferred from the AVTransport events
+    """
+    try:
+        subscription: Subscription = \
+            await device.contentDirectory.subscribe()
+    except Exception as e:
+        print("queue update ids not available: ", repr(e))
+        return None
+    return QueueUpdateEventHandler(
+        subscription, 
+        controller.callback_queue_changed,
+    )
+
+
 async def init_event_handler(
     device: SoCo,
     controller: SonosQueueState, 
-    playback_command_queue_empty: Callable[[], bool]
+    playback_command_queue_empty: Callable[[], bool],
+    queue_update_handler: Optional[QueueUpdateEventHandler],
 ) -> SocoEventHandler:
 
     subscription: Subscription = await device.avTransport.subscribe()
-    return SocoEventHandler(
+    event_handler = SocoEventHandler(
         subscription, 
         controller.callback_sonos_event, 
-        playback_command_queue_empty
+        playback_command_queue_empty,
     )
+    if queue_update_handler is not None:
+        event_handler.queue_update_ids_available = \
+            queue_update_handler.queue_update_ids_available
+    return event_handler
+
+
+async def init_topology_handler(
+    device: SoCo,
+    callback_topology_changed: Callable[[], None],
+) -> Optional[ZoneGroupTopologyEventHandler]:
+    """Returns None if the device won't send topology events, the groups
+    are then only updated by rediscovery
+    """
+    try:
+        subscription: Subscription = \
+            await device.zoneGroupTopology.subscribe()
+    except Exception as e:
+        print("zone group topology events not available: ", repr(e))
+        return None
+    return ZoneGroupTopologyEventHandler(
+        subscription, callback_topology_changed
+    )
+
+
+class ZoneGroup(NamedTuple):
+    """Grouped speakers play the coordinator's queue, so they share the
+    coordinator's controller
+    """
+    coordinator: SoCo
+    # names of the speakers in the group, including the coordinator
+    members: frozenset[str]
 
 
 class Controller(NamedTuple):
@@ -59,74 +152,400 @@ class Controller(NamedTuple):
     queue_state: SonosQueueState
     playback: PlaybackController
     websockets: WebSockets
+    executor: DeviceExecutor
 
 
-class Controllers(dict):
-    """Provides access to speaker controller by valid url path"""
-    def __init__(
-        self,
-        controllers: dict[str, Controller],
-        clean_ups: list[Callable[[], Awaitable[None]]]
-    ) -> None:
+CleanUp = Callable[[], Awaitable[None]]
+Discover = Callable[[], Awaitable[dict[str, ZoneGroup]]]
 
-        self.update(controllers)
-        self._clean_ups = clean_ups
-        self._add_valid_paths_to_self()
-        self.paths = {p for p in self.keys() if p.startswith("/")}
 
-    async def clean_up(self):
-        for clean_up in self._clean_ups:
+async def _run_clean_ups(clean_ups: list[CleanUp]) -> None:
+    for clean_up in clean_ups:
+        try:
             await clean_up()
+        except Exception as e:
+            # e.g. unsubscribing from a speaker that's gone
+            print("clean up failed: ", repr(e))
+
+
+def zone_groups(device: SoCo) -> dict[str, ZoneGroup]:
+    """Every group in the household by coordinator name, from any one
+    of its speakers. Blocks, soco asks the speaker for the topology 
+    unless a topology subscription is keeping it up to date
+    """
+    return {
+        group.coordinator.player_name: ZoneGroup(
+            group.coordinator,
+            frozenset(
+                member.player_name 
+                for member in group.members 
+                # e.g. the sub and surrounds of a home theatre
+                if member.is_visible
+            ),
+        )
+        for group in device.all_groups
+    }
+
+
+async def read_groups(devices: Iterable[SoCo]) -> dict[str, ZoneGroup]:
+    """The groups from the first speaker that answers"""
+    loop = asyncio.get_event_loop()
+    for device in devices:
+        try:
+            return await loop.run_in_executor(None, zone_groups, device)
+        except Exception as e:
+            print("failed to read zone groups: ", repr(e))
+    return {}
+
+
+async def discover_groups(
+    timeout: float = DISCOVERY_TIMEOUT,
+) -> dict[str, ZoneGroup]:
+    """Zone groups by coordinator name. Discovery is multicast and can 
+    miss speakers but every speaker knows the whole topology
+    """
+    loop = asyncio.get_event_loop()
+    devices = await loop.run_in_executor(
+        None, partial(soco.discovery.discover, timeout=timeout)
+    )
+    return await read_groups(devices or ())
 
-    def _add_valid_paths_to_self(self) -> None:
-        """Converts speaker names to lower case with no punctuation
-        This is used to make it easy to provide the speaker name
-        in the browser
-        """
-        alpha_numeric_path = lambda s: "/" + re.sub(r'\W+', '', s)
-        alpha_numeric_path_lower = lambda s: alpha_numeric_path(s).lower()
-        additional_paths = {
-            a_n_p(name): controller
-            for name, controller in self.items()
-            for a_n_p in (alpha_numeric_path, alpha_numeric_path_lower)
-        }
-        self.update(additional_paths)
-
-
-async def init_controllers(WebSockets) -> Controllers:
-    """inits the object model"""
-
-    controllers: dict[str, Controller] = {}
-    clean_ups: list[Callable[[], Awaitable[None]]] = []
-
-    device: SoCo
-    for device in soco.discovery.discover():
-
-        art_downloader = init_art_downloader()
 
+async def init_controller(
+    snapshots: QueueSnapshots,
+    art_index: ArtIndex,
+    art_downloader: ArtDownloader,
+    WebSockets,
+    name: str,
+    device: SoCo,
+    callback_topology_changed: Callable[[], None],
+) -> tuple[Controller, list[CleanUp]]:
+    """Sets up a group's coordinator, anything already set up is cleaned
+    up if it fails or is cancelled part way through
+    """
+    clean_ups: list[CleanUp] = []
+    try:
+        # each speaker's blocking calls get their own threads
+        executor = DeviceExecutor(name)
+        clean_ups.append(executor.clean_up)
         playback_controller, playback_command_queue_empty = \
-            init_playback_controller(device)
+            init_playback_controller(device, art_index, executor)
+        # stopped before the executor is shut down
+        clean_ups.insert(0, playback_controller.clean_up)
 
         websockets = WebSockets()
+        clean_ups.append(websockets.clean_up)
 
         controller = SonosQueueState(
-            playback_controller.get_queue, 
+            playback_controller.get_queue_page, 
             art_downloader.enqueue_art, 
-            websockets.send_queue,
+            websockets.send_message,
+            snapshots.load(name, playback_controller.queue_item),
+            partial(snapshots.save, name),
         )
+        playback_controller.callback_command = controller.callback_command
+        clean_ups.insert(0, controller.clean_up)
 
+        queue_update_handler = await init_queue_update_handler(
+            device, controller
+        )
+        if queue_update_handler is not None:
+            clean_ups.insert(0, queue_update_handler.clean_up)
         event_handler = await init_event_handler(
-            device, controller, playback_command_queue_empty
+            device, 
+            controller, 
+            playback_command_queue_empty, 
+            queue_update_handler,
         )
+        clean_ups.insert(0, event_handler.clean_up)
+        topology_handler = await init_topology_handler(
+            device, callback_topology_changed
+        )
+        if topology_handler is not None:
+            clean_ups.insert(0, topology_handler.clean_up)
+    except BaseException:
+        await _run_clean_ups(clean_ups)
+        raise
+
+    return (
+        Controller(
+            name, controller, playback_controller, websockets, executor
+        ),
+        clean_ups,
+    )
+
+
+def _valid_paths(name: str) -> set[str]:
+    """Converts speaker names to lower case with no punctuation
+    This is used to make it easy to provide the speaker name
+    in the browser
+    """
+    alpha_numeric_path = "/" + re.sub(r'\W+', '', name)
+    return {alpha_numeric_path, alpha_numeric_path.lower()}
+
+
+class Controllers(dict):
+    """Provides access to speaker controller by valid url path
+    There's a controller for each zone group's coordinator, the paths of
+    the other speakers in the group lead to it. Groups are read again
+    when the topology changes and speakers are looked for again in the
+    background, new groups are added and groups that have gone are
+    removed
+    """
+    def __init__(
+        self,
+        init_controller: Callable[
+            [str, SoCo, Callable[[], None]],
+            Awaitable[tuple[Controller, list[CleanUp]]],
+        ],
+        clean_ups: list[CleanUp],
+        art_index: ArtIndex,
+        thumbnails: Thumbnails,
+        init_timeout: float = CONTROLLER_INIT_TIMEOUT,
+        regroup_delay: float = REGROUP_DELAY,
+    ) -> None:
 
-        controllers[device.player_name] = Controller(
-            device.player_name, controller, playback_controller, websockets
+        self._init_controller = init_controller
+        self._clean_ups = clean_ups
+        self.art_index = art_index
+        self.thumbnails = thumbnails
+        self._init_timeout = init_timeout
+        self._regroup_delay = regroup_delay
+        self.paths: set[str] = set()
+        # coordinator name -> its controller, clean ups and group
+        self._controllers: dict[str, Controller] = {}
+        self._controller_clean_ups: dict[str, list[CleanUp]] = {}
+        self._groups: dict[str, ZoneGroup] = {}
+        # coordinator name -> discoveries in a row it's been missing from
+        self._missed: dict[str, int] = {}
+        # topology events and rediscovery mustn't change groups at once
+        self._updating = asyncio.Lock()
+        self._regroup_handle: Optional[asyncio.TimerHandle] = None
+        self._regroup: Optional[asyncio.Task] = None
+        self._rediscovery: Optional[asyncio.Task] = None
+
+    @property
+    def names(self) -> set[str]:
+        """The coordinators' names"""
+        return set(self._controllers)
+
+    @property
+    def groups(self) -> dict[str, ZoneGroup]:
+        return dict(self._groups)
+
+    def art_in_use(self) -> set[str]:
+        """Art the art index mustn't evict"""
+        return set().union(*(
+            controller.queue_state.art_in_use()
+            for controller in self._controllers.values()
+        ))
+
+    async def clean_up(self):
+        if self._regroup_handle is not None:
+            self._regroup_handle.cancel()
+        for task in (self._regroup, self._rediscovery):
+            if task is not None:
+                task.cancel()
+        for name in list(self._controllers):
+            await self.remove(name)
+        await _run_clean_ups(self._clean_ups)
+
+    async def _init_with_timeout(
+        self,
+        name: str,
+        device: SoCo,
+    ) -> Optional[tuple[Controller, list[CleanUp]]]:
+        try:
+            return await asyncio.wait_for(
+                self._init_controller(
+                    name, device, self.callback_topology_changed
+                ),
+                self._init_timeout,
+            )
+        except Exception as e:
+            # tried again at the next discovery
+            print("failed to set up speaker: ", name, repr(e))
+            return None
+
+    async def update_groups(self, groups: dict[str, ZoneGroup]) -> None:
+        """Removes the controllers of speakers that are no longer
+        coordinators, sets up the new coordinators all at once then
+        points every speaker's paths at its group's controller
+        """
+        async with self._updating:
+            await self._update_groups(groups)
+
+    async def _update_groups(self, groups: dict[str, ZoneGroup]) -> None:
+        for name in self.names - set(groups):
+            await self.remove(name)
+        new = {
+            name: group.coordinator
+            for name, group in groups.items()
+            if name not in self._controllers
+        }
+        results = await asyncio.gather(
+            *(self._init_with_timeout(n, d) for n, d in new.items())
         )
+        for result in results:
+            if result is not None:
+                self._add(*result)
+        for name, group in groups.items():
+            if name in self._controllers and (
+                self._groups.get(name, group).members != group.members
+            ):
+                print("speakers grouped: ", name, sorted(group.members))
+        self._groups = {
+            name: group
+            for name, group in groups.items()
+            if name in self._controllers
+        }
+        self._route()
 
-        clean_ups.append(websockets.clean_up)
-        clean_ups.append(event_handler.clean_up)
-        clean_ups.append(art_downloader.clean_up)
+    def _route(self) -> None:
+        """A coordinator's own name and paths win over a member's that
+        happen to be the same
+        """
+        self.clear()
+        self.paths.clear()
+        for name in self._groups:
+            self._add_paths(name, self._controllers[name])
+        for name, group in self._groups.items():
+            for member in sorted(group.members - {name}):
+                self._add_paths(member, self._controllers[name])
+
+    def _add_paths(self, name: str, controller: Controller) -> None:
+        self.setdefault(name, controller)
+        for path in _valid_paths(name):
+            self.setdefault(path, controller)
+            self.paths.add(path)
+
+    def _add(self, controller: Controller, clean_ups: list[CleanUp]) -> None:
+        self._controllers[controller.name] = controller
+        self._controller_clean_ups[controller.name] = clean_ups
+        print("speaker added: ", controller.name)
+
+    async def remove(self, name: str) -> None:
+        """The group's paths are removed straight away"""
+        self._controllers.pop(name)
+        clean_ups = self._controller_clean_ups.pop(name)
+        self._groups.pop(name, None)
+        self._route()
+        self._missed.pop(name, None)
+        await _run_clean_ups(clean_ups)
+        print("speaker removed: ", name)
+
+    def callback_topology_changed(self) -> None:
+        """Called for each ZoneGroupTopology event from any coordinator,
+        the groups are read once the events stop
+        """
+        if self._regroup_handle is not None:
+            self._regroup_handle.cancel()
+        loop = asyncio.get_event_loop()
+        self._regroup_handle = loop.call_later(
+            self._regroup_delay, self._start_regroup
+        )
 
-    clean_ups.append(SocoEventHandler.shutdown_event_listener)
+    def _start_regroup(self) -> None:
+        self._regroup_handle = None
+        self._regroup = asyncio.create_task(self.regroup())
 
-    return Controllers(controllers, clean_ups)
+    async def regroup(self) -> None:
+        """The topology subscriptions keep soco's copy of the groups up
+        to date, so reading them doesn't usually need the network. The 
+        groups are read and applied together so an older read is never
+        applied over a newer one
+        """
+        try:
+            async with self._updating:
+                groups = await read_groups(
+                    group.coordinator for group in self._groups.values()
+                )
+                if groups:
+                    await self._update_groups(groups)
+        except Exception as e:
+            print("regrouping failed: ", repr(e))
+
+    async def rediscover(self, discover: Optional[Discover] = None) -> None:
+        """Discovers and applies the groups while no regroup can apply
+        a read of the groups from before the discovery
+        """
+        async with self._updating:
+            groups = await (discover or discover_groups)()
+            for name in groups:
+                self._missed.pop(name, None)
+            grouped = set().union(
+                *(group.members for group in groups.values())
+            )
+            for name in self.names - set(groups):
+                if name in grouped:
+                    # it's joined another group
+                    continue
+                self._missed[name] = self._missed.get(name, 0) + 1
+                # discovery is multicast and can miss a speaker that's
+                # there
+                if self._missed[name] < MISSED_DISCOVERIES:
+                    group = self._groups[name]
+                    groups[name] = group._replace(
+                        members=group.members - grouped
+                    )
+            await self._update_groups(groups)
+
+    async def _run_rediscovery(
+        self,
+        discover: Optional[Discover],
+        interval: float,
+    ) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.rediscover(discover)
+            except Exception as e:
+                print("rediscovery failed: ", repr(e))
+
+    def start_rediscovery(
+        self,
+        discover: Optional[Discover] = None,
+        interval: float = REDISCOVERY_INTERVAL,
+    ) -> None:
+        self._rediscovery = asyncio.create_task(
+            self._run_rediscovery(discover, interval)
+        )
+
+
+async def init_controllers(
+    WebSockets, 
+    discover: Optional[Discover] = None,
+) -> Controllers:
+    """inits the object model, speakers are found with soco discovery
+    unless another way is given e.g. fake_sonos for load tests
+    """
+
+    snapshots = QueueSnapshots()
+    remove_old_art()
+    thumbnails = Thumbnails()
+    art_index = ArtIndex(on_evict=thumbnails.remove)
+    thumbnails.remove_orphans(art_index.image_paths())
+    art_downloader = init_art_downloader(art_index, thumbnails)
+
+    clean_ups: list[CleanUp] = [
+        art_downloader.clean_up,
+        thumbnails.clean_up,
+        art_index.clean_up,
+        SocoEventHandler.shutdown_event_listener,
+    ]
+    controllers = Controllers(
+        partial(
+            init_controller, 
+            snapshots, 
+            art_index, 
+            art_downloader, 
+            WebSockets,
+        ),
+        clean_ups, 
+        art_index, 
+        thumbnails,
+    )
+    art_index.in_use = controllers.art_in_use
+    await controllers.update_groups(await (discover or discover_groups)())
+    controllers.start_rediscovery(discover)
+    return controllers
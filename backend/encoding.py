@@ -0,0 +1,109 @@
+"""Encoding of the messages sent to the clients
+
+Json is the default. Clients can ask for a more compact encoding with a
+websocket subprotocol:
+
+    sonos.dict.v1     json, with the album, artist and art uris of a
+                      queue listed once in a table that the tracks
+                      refer to by index
+    sonos.msgpack.v1  MessagePack binary frames, only offered when
+                      msgpack is installed
+
+orjson is used when it's installed, it's several times faster than the
+json module for the queue messages of large queues.
+"""
+
+from __future__ import annotations
+import json
+from typing import TYPE_CHECKING
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+if TYPE_CHECKING:
+    from typing import Callable, Optional, Union
+
+
+JSON = "json"
+DICTIONARY = "dict"
+MSGPACK = "msgpack"
+
+# websocket subprotocol -> encoding, the server picks the first one the
+# client offers that's here, the order here makes no difference
+SUBPROTOCOLS = {"sonos.dict.v1": DICTIONARY}
+if msgpack is not None:
+    SUBPROTOCOLS["sonos.msgpack.v1"] = MSGPACK
+
+QUEUE_TYPES = frozenset(("queue", "queue_chunk"))
+# item fields kept in the album table
+ALBUM_FIELDS = ("album", "artist", "sonos_art_uri", "server_art_uri")
+TRACK_FIELDS = ("title", "position", "art_available")
+
+
+def dumps(message: dict) -> str:
+    """Compact json, the same whichever library is used"""
+    if orjson is not None:
+        return orjson.dumps(message).decode("utf-8")
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+
+def dictionary_coded(message: dict) -> dict:
+    """Queue items are replaced by a table of the albums and a list of
+    tracks that refer to it, [album index, title, position,
+    art_available]. Other messages are unchanged
+    """
+    if message.get("type") not in QUEUE_TYPES:
+        return message
+    albums: dict[tuple, int] = {}
+    tracks = []
+    for item in message["data"]:
+        if item is None:
+            tracks.append(None)
+            continue
+        album = tuple(item[field] for field in ALBUM_FIELDS)
+        index = albums.setdefault(album, len(albums))
+        tracks.append([index, *(item[field] for field in TRACK_FIELDS)])
+    coded = {k: v for k, v in message.items() if k != "data"}
+    coded["albums"] = list(albums)
+    coded["tracks"] = tracks
+    return coded
+
+
+def _msgpack(message: dict) -> bytes:
+    return msgpack.packb(message)
+
+
+ENCODERS: dict[str, Callable[[dict], Union[str, bytes]]] = {
+    JSON: dumps,
+    DICTIONARY: lambda message: dumps(dictionary_coded(message)),
+    MSGPACK: _msgpack,
+}
+
+
+def encoding_for(protocol: Optional[str]) -> str:
+    return SUBPROTOCOLS.get(protocol, JSON)
+
+
+class EncodedMessage(dict):
+    """A message that keeps its encodings, for messages that are sent
+    many times e.g. the queue to each new client. It mustn't be changed
+    once it's been encoded
+    """
+    __slots__ = ("_encoded",)
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._encoded: dict[str, Union[str, bytes]] = {}
+
+    def encoded(self, encoding: str = JSON) -> Union[str, bytes]:
+        if encoding not in self._encoded:
+            self._encoded[encoding] = ENCODERS[encoding](self)
+        return self._encoded[encoding]
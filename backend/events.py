@@ -3,22 +3,38 @@ and triger callbacks to the controller class
 """
 
 from __future__ import annotations
+import asyncio
 from collections import defaultdict
-from typing import Callable
+from typing import Callable, Optional
 
 import soco
 from soco import events_asyncio
 
+import metrics
+import tracing
+
 
 soco.config.EVENTS_MODULE = events_asyncio
 
 
+# seconds, a burst of events ends once there's been no event for the 
+# quiet window, but is never held for longer than the max latency
+EVENT_QUIET_WINDOW = 0.1
+EVENT_MAX_LATENCY = 0.5
+
+
 class SocoEventHandler:
+    """Events arrive in bursts e.g. TRANSITIONING then PLAYING after a 
+    skip. The variables of each burst are merged and a single update, 
+    which always includes the last event, is sent to the controller
+    """
     def __init__(
         self, 
         subscription: events_asyncio.Subscription,
         callback_sonos_event: Callable[[bool, str, int], None],
         playback_controller_queues_empty: Callable[[], bool],
+        quiet_window: float = EVENT_QUIET_WINDOW,
+        max_latency: float = EVENT_MAX_LATENCY,
     ) -> None:
 
         self.subscription = subscription
@@ -27,23 +43,70 @@ class SocoEventHandler:
         self._callback_sonos_event = callback_sonos_event
         self._playback_controller_queues_empty = \
             playback_controller_queues_empty
+        # replaced when QueueUpdateEventHandler is reporting queue changes
+        self.queue_update_ids_available: Callable[[], bool] = lambda: False
+
+        self._quiet_window = quiet_window
+        self._max_latency = max_latency
+        self._pending_variables: dict = {}
+        self._burst_started: Optional[float] = None
+        self._burst_trace_id: Optional[str] = None
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
 
     def _callback(self, event):
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        if self._burst_started is None:
+            self._burst_started = now
+            self._burst_trace_id = tracing.new_id("event")
+        self._pending_variables.update(event.variables)
+
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        flush_at = min(
+            now + self._quiet_window, 
+            self._burst_started + self._max_latency
+        )
+        self._flush_handle = loop.call_at(flush_at, self._flush)
+
+    def _flush(self):
         if not self._playback_controller_queues_empty():
-            # if there are unprocessed commands don't send the update
+            # if there are unprocessed commands hold on to the update 
+            # until they've run, the state is about to change anyway
+            loop = asyncio.get_event_loop()
+            self._flush_handle = loop.call_later(
+                self._quiet_window, self._flush
+            )
             return
 
-        queue_update_required = self._queue_changed(event.variables)
-        current_state = event.variables['transport_state']
-        current_track = int(event.variables['current_track']) - 1
-        self._callback_sonos_event(
-            queue_update_required,
-            current_state,
-            current_track
-        )
+        self._flush_handle = None
+        burst_started, self._burst_started = self._burst_started, None
+        variables, self._pending_variables = self._pending_variables, {}
+        if not all(v in variables for v in ('transport_state', 'current_track')):
+            return
+
+        if self.queue_update_ids_available():
+            # QueueUpdateEventHandler reports queue changes
+            queue_update_required = False
+        else:
+            queue_update_required = self._queue_changed(variables)
+        current_state = variables['transport_state']
+        current_track = int(variables['current_track']) - 1
+        # the loop's clock is time.monotonic
+        tracing.record("event.burst", self._burst_trace_id, burst_started)
+        with tracing.trace(self._burst_trace_id):
+            self._callback_sonos_event(
+                queue_update_required,
+                current_state,
+                current_track
+            )
+        loop = asyncio.get_event_loop()
+        metrics.EVENT_BROADCAST_SECONDS.observe(loop.time() - burst_started)
 
     def _queue_changed(self, event_variables):
-        """Attempts to work out whether queue has changed"""
+        """Attempts to work out whether queue has changed, this is only 
+        used when the queue's update id isn't available
+        """
         # do this on strings, as hashable objects seem to be being created
         # on each call
         
@@ -87,8 +150,86 @@ class SocoEventHandler:
         return update_required
 
     async def clean_up(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
         await self.subscription.unsubscribe()
 
     @staticmethod
     async def shutdown_event_listener():
-        await events_asyncio.event_listener.async_stop()
\ No newline at end of file
+        await events_asyncio.event_listener.async_stop()
+
+
+def queue_update_id(container_update_ids: str) -> Optional[str]:
+    """Finds the queue's update id in a ContainerUpdateIDs string, 
+    which is a comma separated list of container ids and update ids 
+    e.g. "Q:0,12,S:,3"
+    """
+    values = container_update_ids.split(",")
+    for container, update_id in zip(values[::2], values[1::2]):
+        if container == QueueUpdateEventHandler.QUEUE_CONTAINER:
+            return update_id
+    return None
+
+
+class QueueUpdateEventHandler:
+    """Watches ContentDirectory events for changes to the queue. Sonos
+    bumps the queue container's update id each time the queue is edited 
+    so the queue only needs to be refetched when the update id changes
+    """
+    QUEUE_CONTAINER = "Q:0"
+
+    def __init__(
+        self, 
+        subscription: events_asyncio.Subscription,
+        callback_queue_changed: Callable[[str], None],
+    ) -> None:
+
+        self.subscription = subscription
+        self.subscription.callback = self._callback
+        self.subscription.auto_renew_fail = self._auto_renew_fail
+        self.update_id: Optional[str] = None
+        self.available: bool = True
+        self._callback_queue_changed = callback_queue_changed
+
+    def _callback(self, event):
+        update_id = queue_update_id(
+            event.variables.get('container_update_i_ds', "")
+        )
+        if update_id is None or update_id == self.update_id:
+            return
+        self.update_id = update_id
+        self._callback_queue_changed(update_id)
+
+    def _auto_renew_fail(self, exception):
+        # fall back to working it out from the AVTransport events
+        print("queue update subscription failed: ", repr(exception))
+        self.available = False
+
+    def queue_update_ids_available(self) -> bool:
+        return self.available
+
+    async def clean_up(self) -> None:
+        await self.subscription.unsubscribe()
+
+
+class ZoneGroupTopologyEventHandler:
+    """Reports that speakers have been grouped, ungrouped or have come
+    and gone. soco updates its copy of the groups from the events itself
+    """
+
+    def __init__(
+        self,
+        subscription: events_asyncio.Subscription,
+        callback_topology_changed: Callable[[], None],
+    ) -> None:
+
+        self.subscription = subscription
+        self.subscription.callback = self._callback
+        self._callback_topology_changed = callback_topology_changed
+
+    def _callback(self, event):
+        if "zone_group_state" in event.variables:
+            self._callback_topology_changed()
+
+    async def clean_up(self) -> None:
+        await self.subscription.unsubscribe()
@@ -0,0 +1,246 @@
+"""A simulated speaker so the server can be run and measured without
+sonos hardware
+
+FakeSoCo stands in for the parts of the soco api that the server uses.
+Its calls block for a configurable time like calls to a real speaker,
+and it sends AVTransport and ContentDirectory events through fake
+subscriptions. Each fake speaker is in a group of its own. The album
+art uris point at a fake /getaa server.
+"""
+
+from __future__ import annotations
+import asyncio
+from collections import namedtuple
+import threading
+import time
+from typing import TYPE_CHECKING
+
+from aiohttp import web
+
+
+if TYPE_CHECKING:
+    from typing import Callable, Optional
+
+
+# seconds each call to the speaker blocks for
+DEVICE_LATENCY = 0.02
+# seconds the art server takes to answer
+ART_LATENCY = 0.05
+QUEUE_LENGTH = 500
+TRACKS_PER_ALBUM = 10
+
+# the smallest valid png, a single transparent pixel
+PNG = bytes.fromhex(
+    "89504e470d0a1a0a0000000d49484452000000010000000108060000001f"
+    "15c4890000000b49444154789c6360000200000500017a5eab3f00000000"
+    "49454e44ae426082"
+)
+
+FakeEvent = namedtuple("FakeEvent", "variables")
+FakeTrack = namedtuple("FakeTrack", "title, album, creator, album_art_uri")
+FakePlaylist = namedtuple("FakePlaylist", "title, item_id, tracks")
+FakeZoneGroup = namedtuple("FakeZoneGroup", "coordinator, members")
+
+
+class FakeQueue(list):
+    """A page of the queue as returned by SoCo.get_queue"""
+
+    def __init__(self, items: list, total_matches: int, update_id: int):
+        super().__init__(items)
+        self.number_returned = len(items)
+        self.total_matches = total_matches
+        self.update_id = update_id
+
+
+class FakeSubscription:
+    """Stands in for an events_asyncio.Subscription, events are
+    delivered on the loop like soco's event listener does
+    """
+
+    def __init__(self, service: FakeService) -> None:
+        self.service = service
+        self.callback: Optional[Callable[[FakeEvent], None]] = None
+        self.auto_renew_fail: Optional[Callable[[Exception], None]] = None
+
+    async def unsubscribe(self) -> None:
+        self.service.subscriptions.remove(self)
+
+
+class FakeService:
+    """The fake UPnP event source for one service of the speaker"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+        self.subscriptions: list[FakeSubscription] = []
+
+    async def subscribe(self) -> FakeSubscription:
+        subscription = FakeSubscription(self)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def _deliver(self, event: FakeEvent) -> None:
+        for subscription in list(self.subscriptions):
+            if subscription.callback is not None:
+                subscription.callback(event)
+
+    def send_event(self, variables: dict) -> None:
+        """Can be called from any thread"""
+        self._loop.call_soon_threadsafe(self._deliver, FakeEvent(variables))
+
+
+def fake_tracks(
+    art_server: str,
+    count: int = QUEUE_LENGTH,
+    tracks_per_album: int = TRACKS_PER_ALBUM,
+    prefix: str = "",
+) -> list[FakeTrack]:
+    return [
+        FakeTrack(
+            f"{prefix}Track {i}",
+            f"{prefix}Album {i // tracks_per_album}",
+            f"{prefix}Artist {i // (tracks_per_album * 3)}",
+            f"{art_server}/getaa?s=1&u={prefix}album{i // tracks_per_album}",
+        )
+        for i in range(count)
+    ]
+
+
+class FakeSoCo:
+    """The speaker's state is changed by its calls, each of which blocks
+    for the device latency and is followed by the events a real speaker
+    would send
+    """
+
+    def __init__(
+        self,
+        player_name: str,
+        art_server: str,
+        queue_length: int = QUEUE_LENGTH,
+        latency: float = DEVICE_LATENCY,
+    ) -> None:
+
+        loop = asyncio.get_event_loop()
+        self.player_name = player_name
+        self.avTransport = FakeService(loop)
+        self.contentDirectory = FakeService(loop)
+        self.zoneGroupTopology = FakeService(loop)
+        self.is_visible = True
+        self._latency = latency
+        # calls run in worker threads
+        self._lock = threading.Lock()
+        self._queue = fake_tracks(art_server, queue_length)
+        self._update_id = 1
+        self.transport_state = "STOPPED"
+        self.current_track = 0
+        self.calls = 0
+        self._playlists = [
+            FakePlaylist(
+                name, f"SQ:{i}", fake_tracks(art_server, 50, prefix=name)
+            )
+            for i, name in enumerate(("kids", "dinner"))
+        ]
+
+    @property
+    def all_groups(self) -> set[FakeZoneGroup]:
+        return {FakeZoneGroup(self, (self,))}
+
+    def _call(self) -> None:
+        with self._lock:
+            self.calls += 1
+        time.sleep(self._latency)
+
+    def _transport_variables(self) -> dict:
+        return {
+            "transport_state": self.transport_state,
+            "current_track": str(self.current_track + 1),
+            "number_of_tracks": str(len(self._queue)),
+        }
+
+    def send_transport_event(self, transport_state: str) -> None:
+        variables = self._transport_variables()
+        variables["transport_state"] = transport_state
+        self.avTransport.send_event(variables)
+
+    def event_storm(self, count: int) -> None:
+        """Repeats the current state, as a speaker does when e.g. the
+        volume is changed from the sonos app
+        """
+        for _ in range(count):
+            self.avTransport.send_event(self._transport_variables())
+
+    def _change_transport(self, state: str, track: Optional[int]) -> None:
+        self.send_transport_event("TRANSITIONING")
+        with self._lock:
+            self.transport_state = state
+            if track is not None:
+                self.current_track = track
+        self.avTransport.send_event(self._transport_variables())
+
+    def _change_queue(self) -> None:
+        with self._lock:
+            self._update_id += 1
+            update_id = self._update_id
+        self.contentDirectory.send_event(
+            {"container_update_i_ds": f"Q:0,{update_id}"}
+        )
+        self.avTransport.send_event(self._transport_variables())
+
+    def play(self) -> None:
+        self._call()
+        self._change_transport("PLAYING", None)
+
+    def pause(self) -> None:
+        self._call()
+        self._change_transport("PAUSED_PLAYBACK", None)
+
+    def play_from_queue(self, index: int) -> None:
+        self._call()
+        if not 0 <= index < len(self._queue):
+            raise IndexError(index)
+        self._change_transport("PLAYING", index)
+
+    def get_queue(
+        self,
+        start: int = 0,
+        max_items: int = 100,
+        full_album_art_uri: bool = False,
+    ) -> FakeQueue:
+        self._call()
+        with self._lock:
+            return FakeQueue(
+                self._queue[start:start + max_items],
+                len(self._queue),
+                self._update_id,
+            )
+
+    def get_sonos_playlists(self) -> list[FakePlaylist]:
+        self._call()
+        return list(self._playlists)
+
+    def clear_queue(self) -> None:
+        self._call()
+        with self._lock:
+            self._queue = []
+            self.current_track = 0
+        self._change_queue()
+
+    def add_to_queue(self, playlist: FakePlaylist) -> None:
+        self._call()
+        with self._lock:
+            self._queue.extend(playlist.tracks)
+        self._change_queue()
+
+
+class FakeArtServer:
+    """Answers /getaa like a speaker does, slowly"""
+
+    def __init__(self, latency: float = ART_LATENCY) -> None:
+        self._latency = latency
+        self.requests = 0
+        self.app = web.Application()
+        self.app.router.add_get("/getaa", self.getaa)
+
+    async def getaa(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(self._latency)
+        return web.Response(body=PNG, content_type="image/png")
@@ -0,0 +1,281 @@
+"""Runs the server against simulated speakers and measures it
+
+N websocket clients connect to each speaker. Commands are sent from the
+clients in turn and the time until each client sees the command in a
+transport message is measured. Storms of AVTransport events are then
+sent by the speakers. Run from the backend directory, a temporary
+directory is used for the cache:
+
+    python load_test.py --clients 50 --commands 200
+"""
+
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import tempfile
+import time
+from typing import TYPE_CHECKING
+
+from aiohttp import ClientSession, WSMsgType
+from aiohttp.test_utils import TestServer
+
+from broadcast import split_command_id
+from controller import ZoneGroup, init_controllers
+from encoding import msgpack
+from fake_sonos import (
+    ART_LATENCY, DEVICE_LATENCY, QUEUE_LENGTH, FakeArtServer, FakeSoCo
+)
+import server
+import sonos
+
+
+if TYPE_CHECKING:
+    from typing import Optional
+    from aiohttp import ClientWebSocketResponse
+
+
+# seconds between commands and between event storms
+COMMAND_INTERVAL = 0.01
+STORM_INTERVAL = 1
+STORM_SIZE = 20
+
+
+def percentile(values: list[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class LoadClient:
+    """A websocket client that records when it sees each command"""
+
+    def __init__(self, websocket: ClientWebSocketResponse) -> None:
+        self.websocket = websocket
+        self.messages = 0
+        # command id -> time first seen, time confirmed, time its 
+        # outcome was seen whether confirmed, rolled back or superseded,
+        # clients are only told the outcome of the commands they sent
+        self.acknowledged: dict[str, float] = {}
+        self.confirmed: dict[str, float] = {}
+        self.resolved: dict[str, float] = {}
+        # time of each transport message that wasn't for a command
+        self.transport: list[float] = []
+        self._task = asyncio.create_task(self._read())
+
+    async def _read(self) -> None:
+        async for msg in self.websocket:
+            if msg.type not in (WSMsgType.text, WSMsgType.binary):
+                break
+            received = time.monotonic()
+            self.messages += 1
+            message = (
+                json.loads(msg.data) if msg.type == WSMsgType.text 
+                else msgpack.unpackb(msg.data)
+            )
+            if message["type"] != "transport":
+                continue
+            command_id = message["command_id"]
+            if command_id is not None:
+                _, command_id = split_command_id(command_id)
+            if command_id is None:
+                self.transport.append(received)
+            elif message["optimistic"]:
+                self.acknowledged.setdefault(command_id, received)
+            else:
+                self.resolved.setdefault(command_id, received)
+                if message["confirmed"]:
+                    self.confirmed.setdefault(command_id, received)
+
+    async def send_command(self, command: str, args: list, command_id: str):
+        await self.websocket.send_str(json.dumps(
+            {"command": command, "args": args, "id": command_id}
+        ))
+
+    async def close(self) -> None:
+        await self.websocket.close()
+        await self._task
+
+
+async def _send_commands(
+    clients: list[LoadClient],
+    commands: int,
+    queue_length: int,
+) -> dict[str, float]:
+    sent = {}
+    for i in range(commands):
+        command_id = str(i)
+        command, args = random.choice((
+            ("play_index", [random.randrange(queue_length)]),
+            ("play", []),
+            ("pause", []),
+        ))
+        sent[command_id] = time.monotonic()
+        await clients[i % len(clients)].send_command(command, args, command_id)
+        await asyncio.sleep(COMMAND_INTERVAL)
+    return sent
+
+
+async def _send_storms(
+    devices: list[FakeSoCo],
+    storms: int,
+) -> list[float]:
+    sent = []
+    for _ in range(storms):
+        sent.append(time.monotonic())
+        for device in devices:
+            device.event_storm(STORM_SIZE)
+        await asyncio.sleep(STORM_INTERVAL)
+    return sent
+
+
+def _latencies(sent: dict[str, float], seen: dict[str, float]) -> list[float]:
+    return [seen[i] - sent[i] for i in seen if i in sent]
+
+
+def _storm_latencies(sent: list[float], seen: list[float]) -> list[float]:
+    """The first transport message after each storm"""
+    latencies = []
+    for storm in sent:
+        after = [t for t in seen if t >= storm]
+        if after:
+            latencies.append(min(after) - storm)
+    return latencies
+
+
+def _summary(name: str, latencies: list[float]) -> dict:
+    return {
+        f"{name}_count": len(latencies),
+        f"{name}_p50_ms": _ms(percentile(latencies, 0.5)),
+        f"{name}_p99_ms": _ms(percentile(latencies, 0.99)),
+    }
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+async def run_load_test(
+    clients: int = 20,
+    speakers: int = 1,
+    commands: int = 100,
+    storms: int = 3,
+    queue_length: int = QUEUE_LENGTH,
+    device_latency: float = DEVICE_LATENCY,
+    art_latency: float = ART_LATENCY,
+    settle: Optional[float] = None,
+    protocol: Optional[str] = None,
+) -> dict:
+    """Uses the cache folders under the current directory. The clients
+    ask for the websocket subprotocol given, e.g. sonos.dict.v1
+    """
+    async with TestServer(FakeArtServer(art_latency).app) as art_server:
+        art_url = str(art_server.make_url("")).rstrip("/")
+        devices = {
+            f"Speaker {i}": FakeSoCo(
+                f"Speaker {i}", art_url, queue_length, device_latency
+            )
+            for i in range(speakers)
+        }
+
+        async def discover():
+            return {
+                name: ZoneGroup(device, frozenset((name,)))
+                for name, device in devices.items()
+            }
+
+        controllers = await init_controllers(server.WebSockets, discover)
+        app = await server.init_app(controllers)
+        async with TestServer(app) as app_server, ClientSession() as session:
+            load_clients = []
+            for name in devices:
+                path = "/" + re.sub(r'\W+', '', name).lower()
+                for _ in range(clients):
+                    websocket = await session.ws_connect(
+                        app_server.make_url(path),
+                        protocols=() if protocol is None else (protocol,),
+                    )
+                    load_clients.append(LoadClient(websocket))
+
+            started = time.monotonic()
+            sent_commands = await _send_commands(
+                load_clients, commands, queue_length
+            )
+            # unconfirmed commands are rolled back after the timeout
+            await asyncio.sleep(
+                sonos.OPTIMISTIC_TIMEOUT + 0.5 if settle is None else settle
+            )
+            sent_storms = await _send_storms(list(devices.values()), storms)
+            duration = time.monotonic() - started
+
+            for client in load_clients:
+                await client.close()
+
+    messages = sum(c.messages for c in load_clients)
+    results = {
+        "clients": len(load_clients),
+        "commands": commands,
+        "messages": messages,
+        "duration_s": round(duration, 2),
+        "messages_per_s": round(messages / duration, 1),
+    }
+    for name, latencies in (
+        ("ack", [
+            latency for c in load_clients
+            for latency in _latencies(sent_commands, c.acknowledged)
+        ]),
+        ("confirm", [
+            latency for c in load_clients
+            for latency in _latencies(sent_commands, c.confirmed)
+        ]),
+        ("resolve", [
+            latency for c in load_clients
+            for latency in _latencies(sent_commands, c.resolved)
+        ]),
+        ("event", [
+            latency for c in load_clients
+            for latency in _storm_latencies(sent_storms, c.transport)
+        ]),
+    ):
+        results.update(_summary(name, latencies))
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--clients", type=int, default=20,
+        help="websocket clients per speaker")
+    parser.add_argument("--speakers", type=int, default=1)
+    parser.add_argument("--commands", type=int, default=100)
+    parser.add_argument("--storms", type=int, default=3)
+    parser.add_argument("--queue-length", type=int, default=QUEUE_LENGTH)
+    parser.add_argument("--device-latency", type=float,
+        default=DEVICE_LATENCY, help="seconds")
+    parser.add_argument("--art-latency", type=float, default=ART_LATENCY,
+        help="seconds")
+    parser.add_argument("--protocol",
+        help="websocket subprotocol e.g. sonos.dict.v1")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        results = asyncio.run(run_load_test(
+            args.clients,
+            args.speakers,
+            args.commands,
+            args.storms,
+            args.queue_length,
+            args.device_latency,
+            args.art_latency,
+            protocol=args.protocol,
+        ))
+    for key, value in results.items():
+        print(f"{key}: {value}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""Measurements of the server in the prometheus text format
+
+Counters and histograms that are updated as the server runs are module
+level and registered in REGISTRY. Values that are read from the
+controllers, e.g. connected websockets, are collected when /metrics is
+requested. Histograms and counters can be updated from worker threads.
+"""
+
+from __future__ import annotations
+from collections import defaultdict
+import threading
+from typing import TYPE_CHECKING
+
+
+if TYPE_CHECKING:
+    from typing import Iterable
+    from controller import Controllers
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# seconds
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+
+
+def _escape(value: str) -> str:
+    return (
+        value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    )
+
+
+def _labels(labels: Iterable[tuple[str, str]]) -> str:
+    labels = ",".join(f'{k}="{_escape(str(v))}"' for k, v in labels)
+    return "{" + labels + "}" if labels else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """Values keyed by their labels"""
+    type = "untyped"
+
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._values: dict[tuple, float] = defaultdict(float)
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [
+            f"{self.name}{_labels(labels)} {_number(value)}"
+            for labels, value in values
+        ]
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.type}",
+            *self._samples(),
+        ]
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] += amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+
+        super().__init__(name, help)
+        self._buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._counts = [0] * len(self._buckets)
+        self._sum = 0.0
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self._sum += value
+            for i, bucket in enumerate(self._buckets):
+                if value <= bucket:
+                    self._counts[i] += 1
+                    break
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        samples, cumulative = [], 0
+        for bucket, count in zip(self._buckets, counts):
+            cumulative += count
+            samples.append(
+                f'{self.name}_bucket{{le="{_number(bucket)}"}} {cumulative}'
+            )
+        samples.append(f"{self.name}_sum {_number(total)}")
+        samples.append(f"{self.name}_count {cumulative}")
+        return samples
+
+
+class Registry:
+
+    def __init__(self) -> None:
+        self._metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "".join(metric.render() for metric in self._metrics)
+
+
+REGISTRY = Registry()
+
+EVENT_BROADCAST_SECONDS = REGISTRY.register(Histogram(
+    "sonos_event_to_broadcast_seconds",
+    "From the first event of a burst to the transport message being "
+    "queued for the websockets",
+))
+COMMAND_DEVICE_CALL_SECONDS = REGISTRY.register(Histogram(
+    "sonos_command_to_device_call_seconds",
+    "From a command being queued to its soco call starting",
+))
+QUEUE_FETCH_SECONDS = REGISTRY.register(Histogram(
+    "sonos_queue_fetch_seconds",
+    "Time to fetch a page of the queue from the speaker",
+))
+ART_DOWNLOADS = REGISTRY.register(Counter(
+    "sonos_art_downloads_total",
+    "Album art enqueued for download by result, cached means the art "
+    "was already stored",
+))
+ART_DOWNLOAD_BYTES = REGISTRY.register(Counter(
+    "sonos_art_download_bytes_total",
+    "Bytes of album art downloaded from the speakers",
+))
+ART_REQUESTS = REGISTRY.register(Counter(
+    "sonos_art_requests_total",
+    "Album art requests from the clients by whether the art was cached",
+))
+
+
+def controller_metrics(controllers: Controllers) -> list[Metric]:
+    """Read from the controllers each time the metrics are requested"""
+    websockets = Gauge(
+        "sonos_websockets", "Websockets connected to each speaker"
+    )
+    backlog = Gauge(
+        "sonos_command_backlog", "Commands waiting in the command queues"
+    )
+    queued = Gauge(
+        "sonos_device_calls_queued",
+        "Calls waiting for a thread in the speaker's executor",
+    )
+    running = Gauge(
+        "sonos_device_calls_running",
+        "Calls running in the speaker's executor",
+    )
+    calls = Counter("sonos_device_calls_total", "Calls made to the speaker")
+    timeouts = Counter(
+        "sonos_device_call_timeouts_total", "Calls to the speaker timed out"
+    )
+    errors = Counter(
+        "sonos_device_call_errors_total", "Calls to the speaker that failed"
+    )
+    wait_time = Counter(
+        "sonos_device_call_wait_seconds_total",
+        "Time calls spent waiting for a thread",
+    )
+    run_time = Counter(
+        "sonos_device_call_run_seconds_total", "Time calls spent running"
+    )
+
+    for name in sorted(controllers.names):
+        controller = controllers[name]
+        websockets.set(len(controller.websockets), speaker=name)
+        backlog.set(controller.playback.command_backlog(), speaker=name)
+        stats = controller.executor.stats
+        queued.set(stats.queued, speaker=name)
+        running.set(stats.running, speaker=name)
+        calls.set(stats.calls, speaker=name)
+        timeouts.set(stats.timeouts, speaker=name)
+        errors.set(stats.errors, speaker=name)
+        wait_time.set(stats.wait_time, speaker=name)
+        run_time.set(stats.run_time, speaker=name)
+
+    return [
+        websockets, backlog, queued, running, calls, timeouts, errors,
+        wait_time, run_time,
+    ]
+
+
+def render(controllers: Controllers) -> str:
+    return REGISTRY.render() + "".join(
+        metric.render() for metric in controller_metrics(controllers)
+    )
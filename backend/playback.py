@@ -1,15 +1,25 @@
 from __future__ import annotations
+import asyncio
 from functools import partial
 import json
-import os
-import string
-from typing import Callable, TYPE_CHECKING
+import time
+from typing import Callable, Optional, TYPE_CHECKING
+from urllib.parse import unquote
 
-from sonos import QueueItem
+from art_index import art_path
+from broadcast import client_command_id
+import metrics
+import tracing
+from sonos import QueueItem, QueuePage
 
 if TYPE_CHECKING:
     from soco.core import SoCo
-    from queued_executors import LastInQueuedThreadExecutor
+    from soco.data_structures import DidlPlaylistContainer
+    from art_index import ArtIndex
+    from playlists import PlaylistCatalog
+    from queued_executors import (
+        LastInQueuedThreadExecutor, SingleFlightThreadExecutor
+    )
     
 
 class PlaybackController:
@@ -24,9 +34,23 @@ class PlaybackController:
         device: SoCo,
         play_pause_queue: LastInQueuedThreadExecutor,
         play_index_queue: LastInQueuedThreadExecutor,
+        queue_fetches: SingleFlightThreadExecutor,
+        art_index: ArtIndex,
+        playlists: PlaylistCatalog,
     ) -> None:
 
         self._device = device
+        self._queue_fetches = queue_fetches
+        self._art_index = art_index
+        self._playlists = playlists
+        # (playlist item id, queue update id) after the last load
+        self._active_playlist: Optional[tuple[str, int]] = None
+        self._playlist_load: Optional[asyncio.Task] = None
+        # set to SonosQueueState.callback_command so clients can be sent
+        # the expected result of a command straight away
+        self.callback_command: Optional[
+            Callable[[str, tuple, Optional[str]], None]
+        ] = None
         self.command_queue = {
             "play_index": (
                 device.play_from_queue,
@@ -48,9 +72,38 @@ class PlaybackController:
         command, queue = self.command_queue[action]
         queue.put_nowait(command, *args)
         
-    async def parse_client_command(self, json_message: str):
-        message: dict = json.loads(json_message)
-        self._play_command(message["command"], message["args"])
+    async def parse_client_command(
+        self,
+        json_message: str,
+        client_id: Optional[str] = None,
+    ):
+        """The command's id is made unique to the client that sent it"""
+        with tracing.trace(tracing.new_id("command")):
+            with tracing.span("command.parse"):
+                message: dict = json.loads(json_message)
+                action, args = message["command"], message["args"]
+                if not action in self.command_queue:
+                    return
+                self._play_command(action, args)
+            if self.callback_command is not None:
+                command_id = message.get("id")
+                if command_id is not None and client_id is not None:
+                    command_id = client_command_id(client_id, command_id)
+                self.callback_command(action, tuple(args), command_id)
+
+    def command_backlog(self) -> int:
+        """Commands waiting to be sent to the speaker"""
+        queues = {queue for _, queue in self.command_queue.values()}
+        return sum(queue.backlog for queue in queues)
+
+    async def clean_up(self) -> None:
+        """Stops the command queues and any playlist being loaded"""
+        if self._playlist_load is not None:
+            self._playlist_load.cancel()
+            await asyncio.gather(self._playlist_load, return_exceptions=True)
+        for queue in {queue for _, queue in self.command_queue.values()}:
+            await queue.clean_up()
+        await self._playlists.clean_up()
 
     def playback_queues_empty(self):
         return (
@@ -58,46 +111,103 @@ class PlaybackController:
             and self._play_index_queue.tasks_completed
         )
 
-    def load_playlist(self, name):
-        for p in self._device.get_sonos_playlists():
-            if p.title.lower() == name:
-                self._device.clear_queue()
-                self._device.add_to_queue(p)
-                return
+    def request_playlist(self, name: str) -> None:
+        """Loads a playlist in the background, the clients are sent the
+        new queue once the sonos reports the change
+        """
+        if name:
+            self._playlist_load = asyncio.create_task(
+                self._run_load_playlist(unquote(name))
+            )
+
+    async def _run_load_playlist(self, name: str) -> None:
+        try:
+            await self.load_playlist(name)
+        except Exception as e:
+            print("failed to load playlist: ", name, repr(e))
+
+    async def load_playlist(self, name: str) -> None:
+        playlist = await self._playlists.find(name)
+        if playlist is None:
+            return
+        await self._queue_fetches.run(
+            ("playlist", playlist.item_id), self._load_playlist, playlist
+        )
+
+    def _queue_update_id(self) -> int:
+        return self._device.get_queue(max_items=1).update_id
 
-    def _get_device_queue(self):
-        """This polls the sonos system to find out if the queue has 
-        changed. It might be better to execute this in a seperate thread.
+    def _load_playlist(self, playlist: DidlPlaylistContainer) -> None:
+        """Replaces the queue with the playlist unless it was the last 
+        playlist loaded and the queue hasn't changed since, e.g. a 
+        tablet reconnecting. Blocks so runs in a worker thread
+        """
+        if self._active_playlist == (
+            playlist.item_id, self._queue_update_id()
+        ):
+            return
+        self._device.clear_queue()
+        self._device.add_to_queue(playlist)
+        self._active_playlist = (playlist.item_id, self._queue_update_id())
+
+    def _get_device_queue(self, start: int, max_items: int):
+        """This polls the sonos system for a page of the queue. It 
+        blocks so should only be called from a worker thread
         """
         return self._device.get_queue(
+            start=start,
+            max_items=max_items,
             full_album_art_uri=True, 
-            max_items=9999999
         )
 
-    @staticmethod
-    def _server_art_uri(artist: str, album: str):
-        ascii_lower_case = set(c for c in string.ascii_letters)
-        a_z_only = lambda s: "".join(c for c in s if c in ascii_lower_case)
-        path = f"cache/{a_z_only(artist)}___{a_z_only(album)}.png"
-        available = os.path.isfile(path)
-        return path, available
+    def _server_art_uri(self, artist: str, album: str):
+        path = art_path(artist, album)
+        return path, self._art_index.available(path)
 
-    def get_queue(self):
+    async def get_queue_page(self, start: int, max_items: int) -> QueuePage:
+        """Fetches a page of the queue in a worker thread, concurrent 
+        calls for the same page share the same fetch
+        """
+        return await self._queue_fetches.run(
+            ("queue", start, max_items), 
+            self._get_queue_page, 
+            start, 
+            max_items,
+        )
+
+    def queue_item(
+        self, 
+        position: int, 
+        title: str, 
+        album: str, 
+        artist: str, 
+        sonos_art_uri: str,
+    ) -> QueueItem:
+        return QueueItem(
+            title, 
+            album, 
+            artist, 
+            sonos_art_uri, 
+            position, 
+            *self._server_art_uri(artist, album)
+        )
+
+    def _get_queue_page(self, start: int, max_items: int) -> QueuePage:
         get = lambda song, attr: getattr(song, attr, "Unknown")
-        return [
-            QueueItem(
+        started = time.monotonic()
+        songs = self._get_device_queue(start, max_items)
+        metrics.QUEUE_FETCH_SECONDS.observe(time.monotonic() - started)
+        items = [
+            self.queue_item(
+                i,
                 get(song, "title"), 
                 get(song, "album"), 
                 get(song, "creator"), 
                 get(song, "album_art_uri"), 
-                i,
-                *self._server_art_uri(
-                    get(song, "creator"), 
-                    get(song, "album")
-                )
             )
-            for i, song in enumerate(self._get_device_queue())
+            for i, song in enumerate(songs, start)
         ]
+        return QueuePage(start, songs.total_matches, items)
 
 
 def _playback_controller_queues_empty(play_pause_queue, play_index_queue):
@@ -0,0 +1,65 @@
+"""The sonos playlists that can be loaded by name from the page url"""
+
+from __future__ import annotations
+import asyncio
+import time
+from typing import TYPE_CHECKING
+
+
+if TYPE_CHECKING:
+    from typing import Any, Awaitable, Callable, Optional
+
+
+# seconds before the playlists are listed again
+PLAYLIST_REFRESH_INTERVAL = 300
+
+
+class PlaylistCatalog:
+    """Playlists indexed by lower case name. Listing the playlists on
+    the sonos is slow so the list is kept and refreshed in the
+    background once it's older than the refresh interval
+    """
+
+    def __init__(
+        self,
+        get_playlists: Callable[[], Awaitable[list[Any]]],
+        refresh_interval: float = PLAYLIST_REFRESH_INTERVAL,
+    ) -> None:
+
+        self._get_playlists = get_playlists
+        self._refresh_interval = refresh_interval
+        self._by_name: dict[str, Any] = {}
+        self._refreshed: Optional[float] = None
+        self._refresh: Optional[asyncio.Task] = None
+
+    def _stale(self) -> bool:
+        return (
+            self._refreshed is None
+            or time.monotonic() - self._refreshed > self._refresh_interval
+        )
+
+    def _start_refresh(self) -> asyncio.Task:
+        if self._refresh is None or self._refresh.done():
+            self._refresh = asyncio.create_task(self._run_refresh())
+        return self._refresh
+
+    async def _run_refresh(self) -> None:
+        playlists = await self._get_playlists()
+        self._by_name = {p.title.lower(): p for p in playlists}
+        self._refreshed = time.monotonic()
+
+    async def clean_up(self) -> None:
+        if self._refresh is not None:
+            self._refresh.cancel()
+            await asyncio.gather(self._refresh, return_exceptions=True)
+
+    async def find(self, name: str) -> Optional[Any]:
+        """A stale catalog is used straight away while it's refreshed,
+        unless the name isn't in it, as it may be a new playlist
+        """
+        name = name.lower()
+        if self._stale():
+            refresh = self._start_refresh()
+            if name not in self._by_name:
+                await asyncio.shield(refresh)
+        return self._by_name.get(name)
@@ -1,12 +1,115 @@
 from __future__ import annotations
 import asyncio
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import threading
+import time
 
 from typing import TYPE_CHECKING
 
+import metrics
+import tracing
+
 if TYPE_CHECKING:
-    from collections.abc import Callable, Coroutine
-    from typing import Any
+    from collections.abc import Callable, Coroutine, Hashable
+    from concurrent.futures import Future
+    from typing import Any, Optional
+
+
+# worker threads per speaker
+DEVICE_WORKERS = 2
+# seconds a call to a speaker is waited on, including time queued
+DEVICE_CALL_TIMEOUT = 10
+
+
+@dataclass
+class ExecutorStats:
+    queued: int = 0
+    running: int = 0
+    calls: int = 0
+    timeouts: int = 0
+    errors: int = 0
+    # seconds, summed over all calls
+    wait_time: float = 0.0
+    run_time: float = 0.0
+
+
+class DeviceExecutor:
+    """A small thread pool for one speaker's blocking soco calls so that
+    a speaker that stops responding only holds up its own calls. Calls
+    that time out are given up on but can't be stopped, they keep their
+    thread until the speaker answers
+    """
+
+    def __init__(
+        self, 
+        name: str, 
+        max_workers: int = DEVICE_WORKERS, 
+        timeout: float = DEVICE_CALL_TIMEOUT,
+    ) -> None:
+
+        self._executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix=f"soco-{name}"
+        )
+        self._timeout = timeout
+        # stats are updated from the worker threads
+        self._lock = threading.Lock()
+        self.stats = ExecutorStats()
+
+    def _timed_call(self, submitted: float, func, *args, **kwargs):
+        started = time.monotonic()
+        with self._lock:
+            self.stats.queued -= 1
+            self.stats.running += 1
+            self.stats.wait_time += started - submitted
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.stats.errors += 1
+            raise
+        finally:
+            with self._lock:
+                self.stats.running -= 1
+                self.stats.run_time += time.monotonic() - started
+
+    def _call_done(self, future: Future) -> None:
+        # a call cancelled before it started never reached _timed_call
+        if future.cancelled():
+            with self._lock:
+                self.stats.queued -= 1
+
+    async def run(
+        self, 
+        func: Callable[..., Any], 
+        *args, 
+        timeout: Optional[float] = None,
+        **kwargs,
+    ) -> Any:
+        """Raises asyncio.TimeoutError if the call hasn't finished in
+        time
+        """
+        with self._lock:
+            self.stats.queued += 1
+            self.stats.calls += 1
+        loop = asyncio.get_event_loop()
+        future = self._executor.submit(
+            self._timed_call, time.monotonic(), func, *args, **kwargs
+        )
+        future.add_done_callback(self._call_done)
+        try:
+            return await asyncio.wait_for(
+                asyncio.wrap_future(future, loop=loop), 
+                self._timeout if timeout is None else timeout,
+            )
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.stats.timeouts += 1
+            raise
+
+    async def clean_up(self) -> None:
+        self._executor.shutdown(wait=False)
 
 
 class QueuedExecutor(ABC):
@@ -23,6 +126,15 @@ class QueuedExecutor(ABC):
             self.tasks_completed = self._queue.empty()
             self._queue.task_done()
 
+    @property
+    def backlog(self) -> int:
+        return self._queue.qsize()
+
+    async def clean_up(self) -> None:
+        """Drops the queued commands and stops the queue's task"""
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
     async def _graceful_exit(self):
         """place holder, not sure if i need this"""
         await self._queue.join()
@@ -43,16 +155,53 @@ class QueuedExecutor(ABC):
 
 
 class LastInQueuedThreadExecutor(QueuedExecutor):
+    """Commands run on the speaker's DeviceExecutor if given, otherwise
+    on the loop's default thread pool
+    """
 
-    def __init__(self) -> None:
+    def __init__(self, executor: Optional[DeviceExecutor] = None) -> None:
         self._loop: asyncio.AbstractEventLoop = asyncio.get_event_loop()
+        self._executor = executor
+        # when the newest command was put in the queue and its trace id, 
+        # that's the one that runs
+        self._queued_at: float = 0.0
+        self._trace_id: Optional[str] = None
         super().__init__()
 
+    @staticmethod
+    def _timed_command(
+        queued_at: float, 
+        trace_id: Optional[str], 
+        func, 
+        *args, 
+        **kwargs,
+    ):
+        """Runs in a worker thread"""
+        metrics.COMMAND_DEVICE_CALL_SECONDS.observe(
+            time.monotonic() - queued_at
+        )
+        tracing.record("command.queue_wait", trace_id, queued_at)
+        with tracing.span(
+            "command.device_call", trace_id, call=func.__name__
+        ):
+            return func(*args, **kwargs)
+
     async def _run_command(self, func, *args, **kwargs):
         while self._queue.qsize() > 0:
             self._queue.task_done()
             func, args, kwargs = await self._queue.get()
-        await self._loop.run_in_executor(None, func, *args, **kwargs)         
+        args = (self._queued_at, self._trace_id, func, *args)
+        if self._executor is None:
+            await self._loop.run_in_executor(
+                None, self._timed_command, *args, **kwargs
+            )
+            return
+        try:
+            await self._executor.run(self._timed_command, *args, **kwargs)
+        except Exception as e:
+            # the speaker didn't answer or refused the command, carry on
+            # with the commands behind it
+            print("command failed: ", func.__name__, repr(e))
 
     def put_nowait(
         self, 
@@ -61,6 +210,8 @@ class LastInQueuedThreadExecutor(QueuedExecutor):
         **kwargs
     ) -> None:
         """Puts a function with arguements into the queue"""
+        self._queued_at = time.monotonic()
+        self._trace_id = tracing.current()
         super().put_nowait(func, *args, **kwargs)
 
 
@@ -79,3 +230,35 @@ class QueuedAsyncExecutor(QueuedExecutor):
         super().put_nowait(func, *args, **kwargs)
 
 
+class SingleFlightThreadExecutor:
+    """Runs blocking functions in a worker thread. Calls made with the
+    same key while one is already running share its result rather than
+    starting another
+    """
+
+    def __init__(self, executor: Optional[DeviceExecutor] = None) -> None:
+        self._executor = executor
+        self._in_flight: dict[Hashable, asyncio.Future] = {}
+
+    async def run(
+        self, 
+        key: Hashable, 
+        func: Callable[..., Any], 
+        *args
+    ) -> Any:
+        future = self._in_flight.get(key)
+        if future is None:
+            if self._executor is None:
+                loop = asyncio.get_event_loop()
+                future = loop.run_in_executor(None, func, *args)
+            else:
+                future = asyncio.ensure_future(
+                    self._executor.run(func, *args)
+                )
+            self._in_flight[key] = future
+            future.add_done_callback(
+                lambda _: self._in_flight.pop(key, None)
+            )
+        # shield so one caller being cancelled doesn't cancel the others
+        return await asyncio.shield(future)
+
@@ -1,11 +1,16 @@
 from __future__ import annotations
 import asyncio
+from itertools import count
 import os
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Optional
 
 from aiohttp import web
 
+from broadcast import Frame, Outbox, split_command_id
+import encoding
 from controller import init_controllers
+from static import StaticFiles
+import tracing
 import views
 
 
@@ -13,22 +18,89 @@ if TYPE_CHECKING:
     from controller import Controllers
 
 
-class WebSockets(set):
-    async def clean_up(self) -> None:
-        for websocket in self.copy():
-            asyncio.create_task(websocket.close())
-
-    async def _send_message(self, websocket, message):
-        try:
-            await websocket.send_json(message)
-        except ConnectionResetError:
-            pass
+# ids for the websockets of all the speakers
+_client_ids = count(1)
+
+
+class WebSockets(dict):
+    """Websockets connected to a speaker, each with its own outbox"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        # client id -> websocket, for telling a client how its commands
+        # turned out
+        self._clients: dict[str, web.WebSocketResponse] = {}
+
+    def add(self, websocket: web.WebSocketResponse) -> str:
+        """Messages are encoded as the websocket's subprotocol asks,
+        returns the client id its commands are tagged with
+        """
+        client_id = f"c{next(_client_ids)}"
+        self._clients[client_id] = websocket
+        self[websocket] = Outbox(
+            websocket, encoding=encoding.encoding_for(websocket.ws_protocol)
+        )
+        return client_id
+
+    def remove(self, websocket: web.WebSocketResponse) -> None:
+        self._clients = {
+            client_id: client 
+            for client_id, client in self._clients.items()
+            if client is not websocket
+        }
+        outbox = self.pop(websocket, None)
+        if outbox is not None:
+            outbox.close()
 
-    def send_queue(self, queue: dict):
-        for websocket in self.copy():
-            asyncio.create_task(
-                self._send_message(websocket, queue)
-            )
+    async def clean_up(self) -> None:
+        for websocket in list(self):
+            self.remove(websocket)
+
+    def _put(self, websocket: web.WebSocketResponse, frame: Frame) -> None:
+        if not self[websocket].put(frame):
+            # fallen too far behind, the outbox closes the websocket
+            self.remove(websocket)
+
+    def _command_owner(
+        self, 
+        message: dict,
+    ) -> Optional[web.WebSocketResponse]:
+        """The websocket that sent the command a message reports the
+        outcome of
+        """
+        command_id = message.get("command_id")
+        if message["type"] != "transport" or command_id is None \
+                or message.get("confirmed") is None:
+            return None
+        return self._clients.get(split_command_id(command_id)[0])
+
+    def send_message(self, message: dict):
+        with tracing.span(
+            "broadcast", type=message["type"], websockets=len(self)
+        ):
+            owner = self._command_owner(message)
+            if message.get("confirmed") is not None:
+                # only the client that sent the command is told how it
+                # turned out and that's never superseded, the others 
+                # just see the new state
+                if owner in self:
+                    self._put(owner, Frame(message, keep=True))
+                message = {
+                    **message, 
+                    "command_id": None, 
+                    "confirmed": None, 
+                    "superseded": False,
+                }
+            frame = Frame(message)
+            for websocket in list(self):
+                if websocket is not owner:
+                    self._put(websocket, frame)
+
+    def send_messages_to(self, websocket, messages: list[dict]):
+        """Sends messages to a single websocket e.g. a new connection"""
+        for message in messages:
+            if websocket in self:
+                self._put(websocket, Frame(message))
 
 
 def _create_art_cache_folder():
@@ -41,16 +113,19 @@ async def init_app(controllers: Controllers):
     """Initialise sonos controller web app"""
     app = web.Application()
     app['controllers'] = controllers
-    
-    for path in controllers.paths:
-        app.router.add_get(path, views.index)
+    app['index_pages'] = views.IndexPages(controllers)
+    app['build_files'] = StaticFiles('../frontend/build')
     
     _create_art_cache_folder()
 
     app.add_routes([
-        web.static('/cache', './cache'),
-        web.static('/static', '../frontend/build/static'),
-        web.static('/', '../frontend/build/'),
+        web.get('/cache/{name}', views.art),
+        web.get('/metrics', views.metrics_page),
+        web.get('/trace', views.trace_page),
+        # catch all, needs to be added last. Speakers come and go while 
+        # the server is running so their pages are looked up on each
+        # request rather than given routes
+        web.get('/{filename:.+}', views.index_or_build_file),
     ])
 
     app.on_shutdown.append(shutdown)
@@ -64,6 +139,7 @@ async def shutdown(app):
 
 
 async def a_main():
+    tracing.enable_from_environment()
     controllers: Controllers = await init_controllers(WebSockets)
     runner = web.AppRunner(await init_app(controllers))
 
@@ -0,0 +1,91 @@
+"""Save each speaker's queue to disk so it can be shown to clients
+straight away after a restart, while the device is checked in the
+background
+"""
+
+from __future__ import annotations
+import asyncio
+import json
+import os
+import re
+from typing import NamedTuple, TYPE_CHECKING
+
+
+if TYPE_CHECKING:
+    from typing import Callable, Optional
+    from sonos import QueueItem
+
+
+SNAPSHOT_FOLDER = "cache/queues"
+
+# bump this if the layout of the snapshot files changes
+SNAPSHOT_FORMAT = 1
+
+
+class QueueSnapshot(NamedTuple):
+    update_id: Optional[str]
+    items: list[QueueItem]
+
+
+class QueueSnapshots:
+    """One compact json file per speaker, holding the queue's update id
+    and the fields that are needed to rebuild each queue item
+    """
+
+    def __init__(self, folder: str = SNAPSHOT_FOLDER) -> None:
+        self._folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self._folder, re.sub(r'\W+', '', name) + ".json")
+
+    def load(
+        self,
+        name: str,
+        queue_item: Callable[[int, str, str, str, str], QueueItem],
+    ) -> Optional[QueueSnapshot]:
+        """Returns None if there isn't a usable snapshot"""
+        try:
+            with open(self._path(name), "r") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if snapshot.get("format") != SNAPSHOT_FORMAT:
+            return None
+
+        items = [
+            queue_item(position, *fields)
+            for position, fields in enumerate(snapshot["items"])
+        ]
+        return QueueSnapshot(snapshot["update_id"], items)
+
+    @staticmethod
+    def _write(path: str, data: str) -> None:
+        # write then rename so a crash can't leave half a snapshot
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    async def save(
+        self,
+        name: str,
+        update_id: Optional[str],
+        items: list[QueueItem],
+    ) -> None:
+        snapshot = {
+            "format": SNAPSHOT_FORMAT,
+            "update_id": update_id,
+            "items": [
+                (item.title, item.album, item.artist, item.sonos_art_uri)
+                for item in items
+            ],
+        }
+        data = json.dumps(snapshot, separators=(",", ":"))
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(
+                None, self._write, self._path(name), data
+            )
+        except OSError as e:
+            print("failed to save queue snapshot: ", repr(e))
@@ -1,33 +1,116 @@
 """Wrap for SoCo library features required for project"""
 
 from __future__ import annotations
-from collections import namedtuple
-from dataclasses import dataclass, asdict
+import asyncio
+from collections import defaultdict, namedtuple
+from sys import intern
 
 from typing import TYPE_CHECKING
 
+from encoding import EncodedMessage
+import tracing
+
 
 if TYPE_CHECKING:
     from aiohttp import web
-    from typing import Callable, Iterable
+    from snapshots import QueueSnapshot
+    from typing import Awaitable, Callable, Iterable, Optional
+
+
+def _intern(s):
+    return intern(s) if type(s) is str else s
 
 
-@dataclass
 class QueueItem:
-    """Container for an item in the queue"""
-    title: str
-    album: str
-    artist: str
-    sonos_art_uri: str
-    position: int
-    server_art_uri: str
-    art_available: bool
+    """Container for an item in the queue. Queues can have thousands of 
+    items so slots are used, and the album, artist and art uris, which 
+    are shared by many items, are interned
+    """
+    __slots__ = (
+        "title", 
+        "album", 
+        "artist", 
+        "sonos_art_uri", 
+        "position", 
+        "server_art_uri", 
+        "art_available",
+    )
+
+    def __init__(
+        self,
+        title: str,
+        album: str,
+        artist: str,
+        sonos_art_uri: str,
+        position: int,
+        server_art_uri: str,
+        art_available: bool,
+    ) -> None:
 
-    def _asdict(self):
-        return asdict(self)
+        self.title = title
+        self.album = _intern(album)
+        self.artist = _intern(artist)
+        self.sonos_art_uri = _intern(sonos_art_uri)
+        self.position = position
+        self.server_art_uri = _intern(server_art_uri)
+        self.art_available = art_available
+
+    def _astuple(self) -> tuple:
+        return (
+            self.title, 
+            self.album, 
+            self.artist, 
+            self.sonos_art_uri, 
+            self.position, 
+            self.server_art_uri, 
+            self.art_available,
+        )
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, QueueItem):
+            return NotImplemented
+        return self._astuple() == other._astuple()
+
+    # mutable, art_available changes once the art is downloaded
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"QueueItem{self._astuple()!r}"
+
+    def _asdict(self) -> dict:
+        return {
+            "title": self.title,
+            "album": self.album,
+            "artist": self.artist,
+            "sonos_art_uri": self.sonos_art_uri,
+            "position": self.position,
+            "server_art_uri": self.server_art_uri,
+            "art_available": self.art_available,
+        }
 
 
 AlbumArtDownload = namedtuple("AlbumArtDownload", "server_uri, sonos_uri")
+QueuePage = namedtuple("QueuePage", "start, total, items")
+OptimisticState = namedtuple(
+    "OptimisticState", "command_id, state, current_track, expiry"
+)
+
+
+# bump this when the shape of the messages sent to clients changes
+PROTOCOL_VERSION = 3
+
+# the first chunk is centred on the current track and kept small so the
+# client can draw the first screen quickly, the rest follow in the 
+# background
+QUEUE_FIRST_CHUNK_SIZE = 30
+QUEUE_CHUNK_SIZE = 200
+
+# art downloaded within this many seconds is reported in one message
+ART_READY_WINDOW = 0.25
+
+# seconds to wait for the device to confirm the result of a command
+# before going back to the last state it reported
+OPTIMISTIC_TIMEOUT = 3
 
 
 class SonosQueueState:
@@ -35,22 +118,59 @@ class SonosQueueState:
 
     def __init__(
         self, 
-        get_device_queue: Callable[[], list[QueueItem]], 
+        get_queue_page: Callable[[int, int], Awaitable[QueuePage]], 
         enqueue_art: Callable[[Iterable[AlbumArtDownload], Callable[[str], None]], None], 
-        queue_sender: Callable[[dict], None]
+        message_sender: Callable[[dict], None],
+        snapshot: Optional[QueueSnapshot] = None,
+        save_snapshot: Optional[
+            Callable[[Optional[str], list[QueueItem]], Awaitable[None]]
+        ] = None,
     ) -> None:
         
-        self._queue: list[QueueItem] = []
+        # items are None while a changed queue is still being streamed
+        self._queue: list[Optional[QueueItem]] = []
+        self._queue_version: int = 0
+        self._queue_loaded = asyncio.Event()
+        # server_art_uri -> queue items with that art
+        self._items_by_art: defaultdict[str, list[QueueItem]] = \
+            defaultdict(list)
+        self._art_ready: set[str] = set()
+        self._art_ready_handle: Optional[asyncio.TimerHandle] = None
+        self._queue_update_id: Optional[str] = None
+        self._saved_update_id: Optional[str] = None
         
         self._queue_update_required: bool = True
+        self._queue_updater: Optional[asyncio.Task] = None
         self._current_state: str = ""
         self._current_track: int = 0
+        self._optimistic: Optional[OptimisticState] = None
+        # built and encoded once for all the clients that connect until
+        # the queue or its art changes
+        self._queue_message: Optional[EncodedMessage] = None
 
-        self._get_device_queue = get_device_queue
+        self._get_queue_page = get_queue_page
         self._enqueue_art = enqueue_art
-        self._queue_sender = queue_sender
+        self._message_sender = message_sender
+        self._save_snapshot = save_snapshot
 
+        if snapshot is not None:
+            self._load_snapshot(snapshot)
 
+    def _load_snapshot(self, snapshot: QueueSnapshot) -> None:
+        """Clients are sent the snapshot until the device has been 
+        checked, that happens in the background when the first events 
+        arrive
+        """
+        self._queue = snapshot.items
+        self._queue_message = None
+        self._index_art(snapshot.items)
+        self._queue_version = 1
+        self._queue_update_id = snapshot.update_id
+        self._saved_update_id = snapshot.update_id
+        self._queue_loaded.set()
+        self._feed_art_downloader(snapshot.items)
+
+    @tracing.traced("queue_state.event")
     def callback_sonos_event(
         self, 
         queue_update_required: bool, 
@@ -58,18 +178,123 @@ class SonosQueueState:
         current_track: int,
     ) -> None:
 
-        self._queue_update_required = queue_update_required
         self._current_state = current_state
         self._current_track = current_track
-        self._queue_sender(self.get_queue_dict())
+        if self._optimistic is None or current_state == "TRANSITIONING":
+            self._message_sender(self.get_transport_message())
+        else:
+            optimistic = self._clear_optimistic()
+            confirmed = (
+                optimistic.state == current_state
+                and optimistic.current_track == current_track
+            )
+            self._message_sender(self.get_transport_message(
+                optimistic.command_id, confirmed
+            ))
+        if queue_update_required or self._queue_update_required:
+            self._request_queue_update()
+
+    @tracing.traced("queue_state.command")
+    def callback_command(
+        self, 
+        action: str, 
+        args: tuple, 
+        command_id: Optional[str],
+    ) -> None:
+        """Clients are sent the expected result of a command straight 
+        away, the next event from the device confirms it or rolls it 
+        back. A command still waiting when the next one arrives is 
+        reported as superseded
+        """
+        current_track = self._current_track
+        if self._optimistic is not None:
+            replaced = self._clear_optimistic()
+            current_track = replaced.current_track
+            if replaced.command_id is not None:
+                self._message_sender(self.get_transport_message(
+                    replaced.command_id, False, superseded=True
+                ))
+        if action == "play_index":
+            state, current_track = "PLAYING", int(args[0])
+        elif action == "play":
+            state = "PLAYING"
+        elif action == "pause":
+            state = "PAUSED_PLAYBACK"
+        else:
+            return
+
+        loop = asyncio.get_event_loop()
+        expiry = loop.call_later(
+            OPTIMISTIC_TIMEOUT, self._optimistic_expired
+        )
+        self._optimistic = OptimisticState(
+            command_id, state, current_track, expiry
+        )
+        self._message_sender(self.get_transport_message())
+
+    def _clear_optimistic(self) -> OptimisticState:
+        optimistic, self._optimistic = self._optimistic, None
+        optimistic.expiry.cancel()
+        return optimistic
+
+    def _optimistic_expired(self) -> None:
+        """The device never confirmed the command, roll back"""
+        optimistic, self._optimistic = self._optimistic, None
+        self._message_sender(self.get_transport_message(
+            optimistic.command_id, False
+        ))
+
+    def callback_queue_changed(self, update_id: str) -> None:
+        """Called when the queue's update id changes"""
+        if update_id == self._queue_update_id and self._queue_loaded.is_set():
+            # e.g. the first event after loading a snapshot, the queue
+            # held is the current one so doesn't need checking
+            self._queue_update_required = False
+            return
+        self._queue_update_id = update_id
+        self._request_queue_update()
+
+    async def clean_up(self) -> None:
+        """Stops the timers and the queue fetch, the speaker's being 
+        removed
+        """
+        if self._art_ready_handle is not None:
+            self._art_ready_handle.cancel()
+            self._art_ready_handle = None
+        if self._optimistic is not None:
+            self._clear_optimistic()
+        if self._queue_updater is not None:
+            self._queue_updater.cancel()
+            await asyncio.gather(self._queue_updater, return_exceptions=True)
 
     def callback_art_downloaded(self, server_uri: str):
-        for queue_item in self._queue:
-            if queue_item.server_art_uri == server_uri:
-                queue_item.art_available = True
-        self._queue_sender(self.get_queue_dict())
+        """Art finishes downloading in bursts so it's reported to the 
+        clients in batches
+        """
+        for queue_item in self._items_by_art.get(server_uri, ()):
+            queue_item.art_available = True
+            self._queue_message = None
+        self._art_ready.add(server_uri)
+        if self._art_ready_handle is None:
+            loop = asyncio.get_event_loop()
+            self._art_ready_handle = loop.call_later(
+                ART_READY_WINDOW, self._send_art_ready
+            )
+
+    def art_in_use(self) -> Iterable[str]:
+        """The server art uris of the current queue"""
+        return self._items_by_art.keys()
+
+    def _send_art_ready(self) -> None:
+        self._art_ready_handle = None
+        server_art_uris, self._art_ready = self._art_ready, set()
+        self._message_sender(self.get_art_ready_message(server_art_uris))
 
-    def _feed_art_downloader(self) -> None:
+    def _index_art(self, items: Iterable[QueueItem]) -> None:
+        for item in items:
+            self._items_by_art[item.server_art_uri].append(item)
+
+    def _feed_art_downloader(self, items: Iterable[QueueItem]) -> None:
         """returns an iterable of namedtuples with album art uris"""
         # a dictionary is used here to remove duplicates and preserve 
         # insertion order
@@ -77,23 +302,183 @@ class SonosQueueState:
             AlbumArtDownload(
                 item.server_art_uri, item.sonos_art_uri
             ): None
-            for item in self._queue
+            for item in items
             if not item.art_available
         }
         self._enqueue_art(art_to_download.keys(), self.callback_art_downloaded)
 
-    def _get_queue(self) -> list[QueueItem]:
-        if not self._queue_update_required:
-            return self._queue
+    def _request_queue_update(self) -> asyncio.Task:
+        """Fetching the queue is slow so it's done in the background,
+        an update requested while a fetch is running is done once the 
+        fetch has finished
+        """
+        self._queue_update_required = True
+        if self._queue_updater is None or self._queue_updater.done():
+            self._queue_updater = asyncio.create_task(
+                self._run_queue_updates()
+            )
+        return self._queue_updater
+
+    async def _run_queue_updates(self) -> None:
+        while self._queue_update_required:
+            self._queue_update_required = False
+            try:
+                with tracing.span("queue_state.refetch"):
+                    changed = await self._stream_queue()
+            except Exception as e:
+                # retried on the next request for an update
+                print("failed to fetch queue: ", repr(e))
+                self._queue_update_required = True
+                return
+            if changed or self._queue_update_id != self._saved_update_id:
+                await self._save_queue_snapshot()
+
+    async def _save_queue_snapshot(self) -> None:
+        if self._save_snapshot is None or self._queue_update_required:
+            # don't save a queue that's about to be replaced
+            return
+        self._saved_update_id = self._queue_update_id
+        await self._save_snapshot(self._queue_update_id, list(self._queue))
+
+    def _remaining_pages(self, first: QueuePage) -> Iterable[tuple[int, int]]:
+        """start and max_items for the pages after the first page then 
+        those before it
+        """
+        end = first.start + len(first.items)
+        for start in range(end, first.total, QUEUE_CHUNK_SIZE):
+            yield start, QUEUE_CHUNK_SIZE
+        end = min(first.start, first.total)
+        for stop in range(end, 0, -QUEUE_CHUNK_SIZE):
+            start = max(0, stop - QUEUE_CHUNK_SIZE)
+            yield start, stop - start
+
+    def _page_changed(self, page: QueuePage) -> bool:
+        end = page.start + len(page.items)
+        return (
+            self._queue_version == 0
+            or page.total != len(self._queue)
+            or page.items != self._queue[page.start:end]
+        )
+
+    async def _stream_queue(self) -> bool:
+        """Fetches the queue a page at a time, starting around the current
+        track. Pages are compared with the queue the clients already 
+        hold and nothing is sent until a page differs, from then on the 
+        new queue is streamed to the clients as chunks. Returns True if
+        the whole of a changed queue was fetched
+        """
+        first_start = max(0, self._current_track - QUEUE_FIRST_CHUNK_SIZE // 2)
+        page = await self._get_queue_page(first_start, QUEUE_FIRST_CHUNK_SIZE)
+        pages = [page]
+        changed = self._page_changed(page)
+        if changed:
+            self._start_new_queue(page.total)
+            self._add_queue_chunk(page)
 
-        self._queue_update_required = False
-        self._queue = self._get_device_queue()
-        self._feed_art_downloader()
-        return self._queue
+        for start, max_items in self._remaining_pages(page):
+            page = await self._get_queue_page(start, max_items)
+            if page.total != pages[0].total:
+                # the queue has changed underneath us, start again
+                self._queue_update_required = True
+                return False
+            pages.append(page)
+            if changed:
+                self._add_queue_chunk(page)
+            elif self._page_changed(page):
+                changed = True
+                self._start_new_queue(page.total)
+                for fetched_page in pages:
+                    self._add_queue_chunk(fetched_page)
 
-    def get_queue_dict(self) -> dict:
+        if changed:
+            self._message_sender(self.get_transport_message())
+        return changed
+
+    def _start_new_queue(self, total: int) -> None:
+        self._queue = [None] * total
+        self._queue_message = None
+        self._items_by_art = defaultdict(list)
+        self._queue_version += 1
+        self._queue_loaded.set()
+
+    def _add_queue_chunk(self, page: QueuePage) -> None:
+        self._queue[page.start:page.start + len(page.items)] = page.items
+        self._queue_message = None
+        self._index_art(page.items)
+        self._feed_art_downloader(page.items)
+        self._message_sender(self.get_queue_chunk_message(page))
+
+    def get_queue_message(self) -> EncodedMessage:
+        """The full queue, only needs sending when the version changes"""
+        if self._queue_message is None:
+            self._queue_message = EncodedMessage({
+                "type": "queue",
+                "version": PROTOCOL_VERSION,
+                "queue_version": self._queue_version,
+                "data": [
+                    q_item._asdict() if q_item else None 
+                    for q_item in self._queue
+                ],
+            })
+        return self._queue_message
+
+    def get_queue_chunk_message(self, page: QueuePage) -> dict:
+        """Part of a queue that is being streamed to the clients"""
         return {
-            "data": [q_item._asdict() for q_item in self._get_queue()],
+            "type": "queue_chunk",
+            "version": PROTOCOL_VERSION,
+            "queue_version": self._queue_version,
+            "start": page.start,
+            "total": page.total,
+            "data": [q_item._asdict() for q_item in page.items],
+        }
+
+    def get_art_ready_message(self, server_art_uris: Iterable[str]) -> dict:
+        """Art that has become available since the queue was sent"""
+        return {
+            "type": "art_ready",
+            "version": PROTOCOL_VERSION,
+            "queue_version": self._queue_version,
+            "server_art_uris": sorted(server_art_uris),
+        }
+
+    def get_transport_message(
+        self, 
+        command_id: Optional[str] = None, 
+        confirmed: Optional[bool] = None,
+        superseded: bool = False,
+    ) -> dict:
+        """Small message sent for every change in the transport state. 
+        While a command is waiting to be confirmed by the device its 
+        expected result is sent, tagged with the command's id. Once it's
+        confirmed, rolled back or superseded by another command the 
+        device's state is sent along with the id and the outcome
+        """
+        message = {
+            "type": "transport",
+            "version": PROTOCOL_VERSION,
+            "queue_version": self._queue_version,
             "current_track": self._current_track,
             "state": self._current_state,
+            "optimistic": False,
+            "command_id": command_id,
+            "confirmed": confirmed,
+            "superseded": superseded,
         }
+        if self._optimistic is not None:
+            message.update(
+                current_track=self._optimistic.current_track,
+                state=self._optimistic.state,
+                optimistic=True,
+                command_id=self._optimistic.command_id,
+            )
+        return message
+
+    async def get_messages(self) -> list[dict]:
+        """Messages required to bring a newly connected client up to date"""
+        if self._queue_update_required:
+            self._request_queue_update()
+        # only wait for the first chunk, the rest is streamed to the 
+        # client as it arrives
+        await self._queue_loaded.wait()
+        return [self.get_queue_message(), self.get_transport_message()]
@@ -0,0 +1,164 @@
+"""Serve the react build with http caching
+
+The build's hashed assets never change so browsers are told to keep
+them, everything else is revalidated using an ETag. Compressed
+versions of text files are made at startup and small files are held in
+memory. Brotli is optional, gzip is always available.
+"""
+
+from __future__ import annotations
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from typing import NamedTuple, TYPE_CHECKING
+
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+if TYPE_CHECKING:
+    from typing import Optional
+
+
+# e.g. main.8a4f2d1c.chunk.js or logo.5d5d9eef.svg
+HASHED_NAME = re.compile(r"\.[0-9a-f]{8,}\.(chunk\.)?[a-z0-9]+$")
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+COMPRESSIBLE_TYPES = (
+    "text/", "application/javascript", "application/json", "image/svg+xml",
+    "image/x-icon", "image/vnd.microsoft.icon",
+)
+MIN_COMPRESS_SIZE = 512
+# files no bigger than this are held in memory, bytes
+MEMORY_LIMIT = 512 * 1024
+
+
+class StaticFile(NamedTuple):
+    path: str
+    content_type: str
+    etag: str
+    cache_control: str
+    # encoding -> body, only for files held in memory
+    bodies: dict[str, bytes]
+
+
+def _compress(data: bytes) -> dict[str, bytes]:
+    variants = {"gzip": gzip.compress(data, compresslevel=9)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(data)
+    return {
+        encoding: body
+        for encoding, body in variants.items()
+        if len(body) < len(data)
+    }
+
+
+def _write_variant(path: str, body: bytes) -> None:
+    """Compressed copies are written next to the originals so they can
+    be used by other servers too
+    """
+    if os.path.isfile(path) and os.path.getsize(path) == len(body):
+        return
+    with open(path + ".tmp", "wb") as f:
+        f.write(body)
+    os.replace(path + ".tmp", path)
+
+
+def _etag(data: bytes) -> str:
+    return '"' + hashlib.sha1(data).hexdigest()[:16] + '"'
+
+
+def _accepted_encodings(request: web.Request) -> set[str]:
+    accept_encoding = request.headers.get("Accept-Encoding", "")
+    return {
+        value.split(";")[0].strip()
+        for value in accept_encoding.split(",")
+    }
+
+
+class StaticFiles:
+    """The files under a folder, looked at once at startup"""
+
+    def __init__(self, folder: str) -> None:
+        self._folder = folder
+        self._files: dict[str, StaticFile] = {}
+        self._scan()
+
+    def _scan(self) -> None:
+        if not os.path.isdir(self._folder):
+            return
+        for root, _, names in os.walk(self._folder):
+            for name in names:
+                if name.endswith((".gz", ".br", ".tmp")):
+                    continue
+                path = os.path.join(root, name)
+                relative = os.path.relpath(path, self._folder)
+                self._files[relative.replace(os.sep, "/")] = self._load(path)
+
+    def _load(self, path: str) -> StaticFile:
+        with open(path, "rb") as f:
+            data = f.read()
+        content_type = mimetypes.guess_type(path)[0] \
+            or "application/octet-stream"
+        cache_control = IMMUTABLE if HASHED_NAME.search(path) else REVALIDATE
+
+        variants: dict[str, bytes] = {}
+        if content_type.startswith(COMPRESSIBLE_TYPES) \
+                and len(data) >= MIN_COMPRESS_SIZE:
+            variants = _compress(data)
+            extensions = {"gzip": ".gz", "br": ".br"}
+            for encoding, body in variants.items():
+                _write_variant(path + extensions[encoding], body)
+
+        bodies: dict[str, bytes] = {}
+        if len(data) <= MEMORY_LIMIT:
+            bodies = {"identity": data, **variants}
+        return StaticFile(
+            path, content_type, _etag(data), cache_control, bodies
+        )
+
+    def get(self, filename: str) -> Optional[StaticFile]:
+        return self._files.get(filename)
+
+    async def handler(self, request: web.Request) -> web.StreamResponse:
+        static_file = self.get(request.match_info["filename"])
+        if static_file is None:
+            raise web.HTTPNotFound()
+        return static_response(request, static_file)
+
+
+def static_response(
+    request: web.Request,
+    static_file: StaticFile,
+) -> web.StreamResponse:
+    headers = {
+        "ETag": static_file.etag,
+        "Cache-Control": static_file.cache_control,
+        "Vary": "Accept-Encoding",
+    }
+    if static_file.etag in request.headers.get("If-None-Match", ""):
+        return web.Response(status=304, headers=headers)
+
+    if not static_file.bodies:
+        # too big to hold in memory, FileResponse streams it from disk
+        # and uses the .gz version if the client accepts it
+        return web.FileResponse(static_file.path, headers=headers)
+
+    accepted = _accepted_encodings(request)
+    for encoding in ("br", "gzip"):
+        if encoding in static_file.bodies and encoding in accepted:
+            headers["Content-Encoding"] = encoding
+            body = static_file.bodies[encoding]
+            break
+    else:
+        body = static_file.bodies["identity"]
+    return web.Response(
+        body=body, content_type=static_file.content_type, headers=headers
+    )
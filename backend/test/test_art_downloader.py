@@ -0,0 +1,130 @@
+
+import asyncio
+
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+import pytest
+
+import art_downloader
+from art_index import ArtIndex, art_path
+from sonos import AlbumArtDownload
+
+
+PNG = b"\x89PNG\r\n\x1a\n"
+
+
+@pytest.mark.asyncio
+async def test_download_retried_and_written_atomically(tmp_path, monkeypatch):
+    monkeypatch.setattr(art_downloader, "RETRY_BACKOFF", 0.001)
+    requests = []
+
+    async def getaa(request):
+        requests.append(request.path)
+        if len(requests) == 1:
+            raise web.HTTPServiceUnavailable()
+        return web.Response(body=PNG)
+
+    app = web.Application()
+    app.router.add_get("/getaa", getaa)
+    art_index = ArtIndex(str(tmp_path))
+    async with TestServer(app) as server:
+        downloader = art_downloader.ArtDownloader(ClientSession(), art_index)
+        album = AlbumArtDownload("cache/album", str(server.make_url("/getaa")))
+        downloaded = []
+        downloader.enqueue_art([album], downloaded.append)
+        await asyncio.gather(*downloader._in_flight.values())
+        await downloader.clean_up()
+
+    assert len(requests) == 2
+    assert downloaded == [album.server_uri]
+    path = art_index.path(album.server_uri)
+    assert path.endswith(".png")
+    assert [str(p) for p in tmp_path.iterdir()] == [path]
+
+
+@pytest.mark.asyncio
+async def test_shared_download_calls_back_every_waiter(tmp_path):
+    requests = []
+
+    async def getaa(request):
+        requests.append(request.path)
+        await asyncio.sleep(0.01)
+        return web.Response(body=PNG)
+
+    app = web.Application()
+    app.router.add_get("/getaa", getaa)
+    async with TestServer(app) as server:
+        downloader = art_downloader.ArtDownloader(
+            ClientSession(), ArtIndex(str(tmp_path))
+        )
+        album = AlbumArtDownload("cache/album", str(server.make_url("/getaa")))
+        bedroom, kitchen = [], []
+        downloader.enqueue_art([album], bedroom.append)
+        downloader.enqueue_art([album], kitchen.append)
+        downloader.enqueue_art([album], kitchen.append)
+        await asyncio.gather(*downloader._in_flight.values())
+        await downloader.clean_up()
+
+    assert len(requests) == 1
+    assert bedroom == kitchen == [album.server_uri]
+
+
+def _add(art_index, tmp_path, alias, data, digest):
+    temp_path = art_index.temp_path()
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    return art_index.add(f"cache/{alias}", temp_path, digest)
+
+
+@pytest.mark.asyncio
+async def test_art_store_deduplicates_and_evicts(tmp_path):
+    evicted = []
+    art_index = ArtIndex(str(tmp_path), max_size=20, on_evict=evicted.append)
+
+    first = _add(art_index, tmp_path, "a", PNG, "1")
+    assert _add(art_index, tmp_path, "b", PNG, "1") == first
+    second = _add(art_index, tmp_path, "c", PNG, "2")
+    assert art_index.path("cache/a") == first
+
+    # "2" is now the least recently used so is evicted
+    third = _add(art_index, tmp_path, "d", PNG, "3")
+    assert evicted == [second]
+    assert not art_index.available("cache/c")
+    assert {art_index.path(f"cache/{a}") for a in "abd"} == {first, third}
+    assert art_index.image_paths() == {first, third}
+
+
+@pytest.mark.asyncio
+async def test_art_in_the_current_queues_not_evicted(tmp_path):
+    evicted = []
+    art_index = ArtIndex(str(tmp_path), max_size=20, on_evict=evicted.append)
+    art_index.in_use = lambda: {"cache/a"}
+
+    first = _add(art_index, tmp_path, "a", PNG, "1")
+    second = _add(art_index, tmp_path, "b", PNG, "2")
+    # "1" is the least recently used but is still in a queue
+    _add(art_index, tmp_path, "c", PNG, "3")
+    assert evicted == [second]
+    assert art_index.path("cache/a") == first
+
+
+@pytest.mark.asyncio
+async def test_art_store_consistency_check(tmp_path):
+    art_index = ArtIndex(str(tmp_path))
+    stored = _add(art_index, tmp_path, "a", PNG, "1")
+    art_index.save()
+    (tmp_path / "partial.part").write_bytes(b"pn")
+    (tmp_path / "orphan.png").write_bytes(PNG)
+
+    restarted = ArtIndex(str(tmp_path))
+    assert restarted.path("cache/a") == stored
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "1.png", "index.json"
+    ]
+
+
+def test_art_path_names_kept_apart():
+    assert art_path("AC/DC", "Back in Black!").startswith(
+        "cache/ACDC___BackinBlack_"
+    )
+    assert art_path("Sigur Rós", "()") != art_path("Sigur Ros", "")
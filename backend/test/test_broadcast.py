@@ -0,0 +1,151 @@
+
+import asyncio
+import json
+
+import pytest
+
+import broadcast
+import encoding
+import server
+
+
+class FakeWebSocket:
+    def __init__(self, compress=0):
+        self.compress = compress
+        self.ws_protocol = None
+        self.sent = []
+        self.compressed = []
+        self.closed = False
+        self.unblock = asyncio.Event()
+
+    async def send_str(self, data, compress=None):
+        await self.unblock.wait()
+        self.sent.append(data)
+        self.compressed.append(compress)
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.mark.asyncio
+async def test_superseded_frames_are_dropped():
+    """Only the latest transport message waiting to be sent is kept"""
+    websocket = FakeWebSocket()
+    outbox = broadcast.Outbox(websocket)
+
+    outbox.put(broadcast.Frame({"type": "transport", "current_track": 0}))
+    await asyncio.sleep(0)
+    # the first frame is now blocked in send_str
+    for current_track in range(1, 4):
+        outbox.put(broadcast.Frame(
+            {"type": "transport", "current_track": current_track}
+        ))
+    outbox.put(broadcast.Frame({"type": "other"}))
+    # kept frames are never dropped
+    outbox.put(broadcast.Frame(
+        {"type": "transport", "current_track": 4, "confirmed": False},
+        keep=True,
+    ))
+    outbox.put(broadcast.Frame({"type": "transport", "current_track": 5}))
+    websocket.unblock.set()
+    await asyncio.sleep(0.01)
+
+    assert websocket.sent == [
+        '{"type":"transport","current_track":0}',
+        '{"type":"other"}',
+        '{"type":"transport","current_track":4,"confirmed":false}',
+        '{"type":"transport","current_track":5}',
+    ]
+    outbox.close()
+
+
+@pytest.mark.asyncio
+async def test_command_outcome_only_sent_to_its_client():
+    websockets = server.WebSockets()
+    sender, other = FakeWebSocket(), FakeWebSocket()
+    client_id = websockets.add(sender)
+    websockets.add(other)
+    command_id = broadcast.client_command_id(client_id, "1")
+
+    for confirmed in (True, False, False):
+        websockets.send_message({
+            "type": "transport", "command_id": command_id,
+            "confirmed": confirmed, "superseded": False,
+        })
+    sender.unblock.set()
+    other.unblock.set()
+    await asyncio.sleep(0.01)
+
+    assert [json.loads(data)["confirmed"] for data in sender.sent] == [
+        True, False, False
+    ]
+    # the others just see the latest state
+    assert [json.loads(data) for data in other.sent] == [{
+        "type": "transport", "command_id": None, "confirmed": None,
+        "superseded": False,
+    }]
+    await websockets.clean_up()
+
+
+@pytest.mark.asyncio
+async def test_slow_consumer_disconnected():
+    websocket = FakeWebSocket()
+    outbox = broadcast.Outbox(websocket, max_size=2)
+
+    frames = [broadcast.Frame({"type": None}) for _ in range(4)]
+    results = [outbox.put(frame) for frame in frames]
+    await asyncio.sleep(0)
+
+    assert results == [True, True, False, False]
+    assert outbox.closed
+    assert websocket.closed
+
+
+@pytest.mark.asyncio
+async def test_frame_encoded_once_for_each_encoding():
+    item = {
+        "title": "Help!", "album": "Help!", "artist": "The Beatles", 
+        "sonos_art_uri": "uri", "position": 0, "server_art_uri": "cache/h",
+        "art_available": True,
+    }
+    frame = broadcast.Frame({
+        "type": "queue", "queue_version": 1, 
+        "data": [item, None, {**item, "title": "Yesterday", "position": 2}],
+    })
+    coded = json.loads(frame.encoded(encoding.DICTIONARY))
+    assert coded["albums"] == [["Help!", "The Beatles", "uri", "cache/h"]]
+    assert coded["tracks"] == [
+        [0, "Help!", 0, True], None, [0, "Yesterday", 2, True]
+    ]
+    assert "data" not in coded
+    assert frame.encoded(encoding.DICTIONARY) is frame.encoded("dict")
+
+    websocket = FakeWebSocket()
+    websocket.unblock.set()
+    outbox = broadcast.Outbox(websocket, encoding=encoding.DICTIONARY)
+    outbox.put(frame)
+    outbox.put(broadcast.Frame({"type": "transport", "current_track": 0}))
+    await asyncio.sleep(0.01)
+    assert websocket.sent == [
+        frame.encoded(encoding.DICTIONARY), 
+        '{"type":"transport","current_track":0}',
+    ]
+    outbox.close()
+
+
+@pytest.mark.asyncio
+async def test_window_only_set_for_websockets_that_agreed_compression():
+    # window bits agreed in the handshake, 0 when it wasn't agreed
+    websockets = [FakeWebSocket(compress) for compress in (0, 15, 9)]
+    outboxes = [
+        broadcast.Outbox(websocket, compress_window_bits=10)
+        for websocket in websockets
+    ]
+    for websocket, outbox in zip(websockets, outboxes):
+        websocket.unblock.set()
+        outbox.put(broadcast.Frame({"type": "other"}))
+    await asyncio.sleep(0.01)
+
+    assert [w.compressed for w in websockets] == [[None], [10], [9]]
+    for outbox in outboxes:
+        outbox.close()
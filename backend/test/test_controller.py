@@ -0,0 +1,225 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+import soco
+
+import controller
+from controller import Controllers, ZoneGroup, init_controllers
+import server
+
+
+class FakeQueue(list):
+
+    def __init__(self, items, total_matches, update_id=1):
+        super().__init__(items)
+        self.number_returned = len(items)
+        self.total_matches = total_matches
+        self.update_id = update_id
+
+
+class FakeService:
+
+    def __init__(self):
+        self.subscriptions = []
+
+    async def subscribe(self):
+        subscription = SimpleNamespace(callback=None)
+
+        async def unsubscribe():
+            self.subscriptions.remove(subscription)
+
+        subscription.unsubscribe = unsubscribe
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def send_event(self, variables):
+        for subscription in self.subscriptions:
+            subscription.callback(SimpleNamespace(variables=variables))
+
+
+class FakeDevice:
+    """Just enough of SoCo for init_controllers"""
+
+    def __init__(self, player_name):
+        self.player_name = player_name
+        self.avTransport = FakeService()
+        self.contentDirectory = FakeService()
+        self.zoneGroupTopology = FakeService()
+        self.is_visible = True
+        self.queue_pages = []
+
+    @property
+    def all_groups(self):
+        return [SimpleNamespace(coordinator=self, members=[self])]
+
+    def play(self):
+        pass
+
+    def pause(self):
+        pass
+
+    def play_from_queue(self, index):
+        pass
+
+    def get_sonos_playlists(self):
+        return []
+
+    def get_queue(self, start=0, max_items=100, full_album_art_uri=False):
+        self.queue_pages.append((start, max_items))
+        return FakeQueue([], 0)
+
+
+@pytest.mark.asyncio
+async def test_init_controllers_wires_up_a_speaker(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    device = FakeDevice("Living Room")
+    monkeypatch.setattr(soco.discovery, "discover", lambda **_: {device})
+
+    controllers = await init_controllers(server.WebSockets)
+    try:
+        assert controllers["/livingroom"] is controllers["Living Room"]
+        # an event leads to the queue being fetched from the speaker
+        device.avTransport.send_event({
+            "transport_state": "PLAYING",
+            "current_track": "1",
+            "number_of_tracks": "0",
+        })
+        for _ in range(50):
+            if device.queue_pages:
+                break
+            await asyncio.sleep(0.02)
+        assert device.queue_pages
+    finally:
+        await controllers.clean_up()
+    assert not device.avTransport.subscriptions
+    # nothing is left running for the removed speaker
+    await asyncio.sleep(0)
+    assert asyncio.all_tasks() == {asyncio.current_task()}
+
+
+class SlowDevice:
+    """Takes delay seconds to set up"""
+
+    def __init__(self, player_name, delay=0):
+        self.player_name = player_name
+        self.delay = delay
+
+
+def group(coordinator, *members):
+    return ZoneGroup(
+        coordinator, frozenset((coordinator.player_name, *members))
+    )
+
+
+def fake_init_controller(cleaned_up, callbacks=None):
+
+    async def init_controller(name, device, callback_topology_changed):
+        await asyncio.sleep(device.delay)
+        if callbacks is not None:
+            callbacks.append(callback_topology_changed)
+        return (
+            SimpleNamespace(name=name),
+            [lambda: asyncio.sleep(0, cleaned_up.append(name))],
+        )
+
+    return init_controller
+
+
+@pytest.mark.asyncio
+async def test_speakers_set_up_at_once_then_added_and_removed(monkeypatch):
+    cleaned_up = []
+    controllers = Controllers(
+        fake_init_controller(cleaned_up), [], None, None, 0.05
+    )
+    # the kitchen never answers so is left out
+    await controllers.update_groups({
+        "Living Room": group(SlowDevice("Living Room", 0.01)),
+        "Kitchen": group(SlowDevice("Kitchen", 1)),
+    })
+    assert controllers.names == {"Living Room"}
+    assert controllers.paths == {"/LivingRoom", "/livingroom"}
+
+    discovered = [
+        {"Kitchen": group(SlowDevice("Kitchen"))},
+        {"Kitchen": group(SlowDevice("Kitchen"))},
+    ]
+
+    async def discover_groups():
+        return discovered.pop(0)
+
+    monkeypatch.setattr(controller, "discover_groups", discover_groups)
+    await controllers.rediscover()
+    assert controllers.names == {"Living Room", "Kitchen"}
+    # only removed once it's been missed twice
+    await controllers.rediscover()
+    assert controllers.names == {"Kitchen"}
+    assert "/livingroom" not in controllers
+    assert cleaned_up == ["Living Room"]
+
+
+@pytest.mark.asyncio
+async def test_group_members_share_the_coordinators_controller(monkeypatch):
+    cleaned_up, callbacks = [], []
+    controllers = Controllers(
+        fake_init_controller(cleaned_up, callbacks), [], None, None,
+        regroup_delay=0.01,
+    )
+    living_room, kitchen = SlowDevice("Living Room"), SlowDevice("Kitchen")
+    await controllers.update_groups({
+        "Living Room": group(living_room),
+        "Kitchen": group(kitchen),
+    })
+
+    reads = []
+
+    async def read_groups(devices):
+        reads.append(list(devices))
+        return {"Living Room": group(living_room, "Kitchen")}
+
+    monkeypatch.setattr(controller, "read_groups", read_groups)
+    # a burst of events from both coordinators leads to one regroup
+    for callback in callbacks * 3:
+        callback()
+    await asyncio.sleep(0.05)
+
+    assert reads == [[living_room, kitchen]]
+    assert controllers.names == {"Living Room"}
+    assert controllers["/kitchen"] is controllers["/livingroom"]
+    assert controllers["Kitchen"].name == "Living Room"
+    assert controllers.paths == {
+        "/LivingRoom", "/livingroom", "/Kitchen", "/kitchen"
+    }
+    assert cleaned_up == ["Kitchen"]
+
+
+@pytest.mark.asyncio
+async def test_regroup_not_overwritten_by_an_older_discovery(monkeypatch):
+    controllers = Controllers(fake_init_controller([]), [], None, None)
+    living_room, kitchen = SlowDevice("Living Room"), SlowDevice("Kitchen")
+    topology = {
+        "Living Room": group(living_room),
+        "Kitchen": group(kitchen),
+    }
+    await controllers.update_groups(topology)
+
+    async def discover():
+        groups = dict(topology)
+        await asyncio.sleep(0.02)
+        return groups
+
+    async def read_groups(devices):
+        return dict(topology)
+
+    monkeypatch.setattr(controller, "read_groups", read_groups)
+    rediscovery = asyncio.create_task(controllers.rediscover(discover))
+    await asyncio.sleep(0)
+    # the speakers are grouped while the discovery is under way
+    topology = {
+        "Bedroom": group(SlowDevice("Bedroom"), "Living Room", "Kitchen"),
+    }
+    await controllers.regroup()
+    await rediscovery
+
+    assert controllers.names == {"Bedroom"}
+    assert controllers["/kitchen"] is controllers["/bedroom"]
@@ -0,0 +1,100 @@
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import events
+
+
+class FakeSubscription:
+    callback = None
+    auto_renew_fail = None
+
+
+def _event(**variables):
+    return SimpleNamespace(variables=variables)
+
+
+def test_queue_update_id():
+    assert events.queue_update_id("Q:0,12,S:,3") == "12"
+    assert events.queue_update_id("S:,3") is None
+    assert events.queue_update_id("") is None
+
+
+def test_queue_changed_only_when_update_id_changes():
+    update_ids = []
+    handler = events.QueueUpdateEventHandler(
+        FakeSubscription(), update_ids.append
+    )
+    for container_update_ids in ("Q:0,1", "S:,4", "Q:0,1", "Q:0,2,S:,5"):
+        handler._callback(_event(container_update_i_ds=container_update_ids))
+    assert update_ids == ["1", "2"]
+
+
+@pytest.mark.asyncio
+async def test_heuristic_skipped_when_update_ids_available():
+    calls = []
+    handler = events.SocoEventHandler(
+        FakeSubscription(), 
+        lambda *args: calls.append(args), 
+        lambda: True,
+        quiet_window=0.001,
+    )
+    handler.queue_update_ids_available = lambda: True
+    stopped = _event(
+        transport_state="STOPPED", current_track="1", number_of_tracks="3"
+    )
+    handler._callback(stopped)
+    await asyncio.sleep(0.01)
+    assert calls == [(False, "STOPPED", 0)]
+
+    handler.queue_update_ids_available = lambda: False
+    handler._callback(stopped)
+    await asyncio.sleep(0.01)
+    assert calls[-1] == (True, "STOPPED", 0)
+
+
+@pytest.mark.asyncio
+async def test_burst_of_events_coalesced():
+    calls = []
+    commands_pending = [True]
+    handler = events.SocoEventHandler(
+        FakeSubscription(), 
+        lambda *args: calls.append(args), 
+        lambda: not commands_pending[0],
+        quiet_window=0.01,
+        max_latency=0.05,
+    )
+    handler._callback(_event(
+        transport_state="TRANSITIONING", current_track="2", 
+        number_of_tracks="3",
+    ))
+    handler._callback(_event(transport_state="PLAYING"))
+    await asyncio.sleep(0.03)
+    # held back while a command is still to run, not dropped
+    assert calls == []
+
+    commands_pending[0] = False
+    await asyncio.sleep(0.03)
+    assert [call[1:] for call in calls] == [("PLAYING", 1)]
+
+
+@pytest.mark.asyncio
+async def test_events_flushed_by_max_latency():
+    calls = []
+    handler = events.SocoEventHandler(
+        FakeSubscription(), 
+        lambda *args: calls.append(args), 
+        lambda: True,
+        quiet_window=0.02,
+        max_latency=0.05,
+    )
+    for current_track in range(1, 10):
+        handler._callback(_event(
+            transport_state="PLAYING", current_track=str(current_track)
+        ))
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.03)
+    assert 2 <= len(calls) < 9
+    assert calls[-1][1:] == ("PLAYING", 8)
@@ -0,0 +1,23 @@
+import pytest
+
+import load_test
+import sonos
+
+
+@pytest.mark.asyncio
+async def test_load_test_against_fake_speaker(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sonos, "OPTIMISTIC_TIMEOUT", 0.2)
+    monkeypatch.setattr(load_test, "STORM_INTERVAL", 0.3)
+
+    results = await load_test.run_load_test(
+        clients=3, commands=6, storms=1, queue_length=40,
+        device_latency=0.001, art_latency=0.001, settle=0.3,
+    )
+    # every client sees every command straight away
+    assert results["ack_count"] == 3 * 6
+    assert results["confirm_count"] > 0
+    # and the sender sees its outcome
+    assert results["resolve_count"] == 6
+    assert results["event_count"] == 3
+    assert results["ack_p50_ms"] <= results["ack_p99_ms"]
@@ -0,0 +1,44 @@
+from types import SimpleNamespace
+
+import metrics
+from queued_executors import ExecutorStats
+
+
+class FakeControllers(dict):
+    @property
+    def names(self):
+        return set(self)
+
+
+def test_histogram_and_counter_text_format():
+    histogram = metrics.Histogram("fetch_seconds", "Fetch time", (0.1, 1))
+    for value in (0.05, 0.5, 0.5, 5):
+        histogram.observe(value)
+    assert histogram.render().splitlines() == [
+        "# HELP fetch_seconds Fetch time",
+        "# TYPE fetch_seconds histogram",
+        'fetch_seconds_bucket{le="0.1"} 1',
+        'fetch_seconds_bucket{le="1.0"} 3',
+        'fetch_seconds_bucket{le="+Inf"} 4',
+        "fetch_seconds_sum 6.05",
+        "fetch_seconds_count 4",
+    ]
+
+    counter = metrics.Counter("downloads_total", "Downloads")
+    counter.inc(result="cached")
+    counter.inc(2, result="cached")
+    assert counter.render().splitlines()[-1] == (
+        'downloads_total{result="cached"} 3.0'
+    )
+
+
+def test_controller_metrics_per_speaker():
+    kids_room = SimpleNamespace(
+        websockets={"a": None, "b": None},
+        playback=SimpleNamespace(command_backlog=lambda: 1),
+        executor=SimpleNamespace(stats=ExecutorStats(queued=2, calls=7)),
+    )
+    text = metrics.render(FakeControllers({'Kid\'s "Room"': kids_room}))
+    assert 'sonos_websockets{speaker="Kid\'s \\"Room\\""} 2.0' in text
+    assert 'sonos_device_calls_total{speaker="Kid\'s \\"Room\\""} 7.0' in text
+    assert "# TYPE sonos_event_to_broadcast_seconds histogram" in text
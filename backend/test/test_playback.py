@@ -1,9 +1,12 @@
 
 import asyncio
 from time import sleep
+from types import SimpleNamespace
 
 import pytest
 
+from playback import PlaybackController
+from playlists import PlaylistCatalog
 import queued_executors
 
 
@@ -56,3 +59,104 @@ async def test_queued_async_executor():
 
     assert tuple(outputs) == (0.001, 0.0001, 0.0002, 0.002)
 
+
+@pytest.mark.asyncio
+async def test_single_flight_thread_executor():
+    """concurrent calls with the same key share one call"""
+    calls = []
+    def slow_call(value):
+        sleep(0.01)
+        calls.append(value)
+        return value
+
+    executor = queued_executors.SingleFlightThreadExecutor()
+    results = await asyncio.gather(
+        *(executor.run("key", slow_call, i) for i in range(3))
+    )
+    assert calls == [0]
+    assert results == [0, 0, 0]
+
+    assert await executor.run("key", slow_call, 4) == 4
+
+
+@pytest.mark.asyncio
+async def test_device_executor_times_out_and_counts():
+    executor = queued_executors.DeviceExecutor("kitchen", max_workers=1)
+
+    assert await executor.run(sleep, 0) is None
+    # the second call waits behind the first and is never started
+    results = await asyncio.gather(
+        executor.run(sleep, 0.05, timeout=0.01),
+        executor.run(sleep, 0, timeout=0.01),
+        return_exceptions=True,
+    )
+    assert all(isinstance(r, asyncio.TimeoutError) for r in results)
+    await asyncio.sleep(0.06)
+
+    stats = executor.stats
+    assert (stats.calls, stats.timeouts, stats.queued, stats.running) == (
+        3, 2, 0, 0
+    )
+    assert stats.run_time >= 0.05
+    await executor.clean_up()
+
+
+@pytest.mark.asyncio
+async def test_playlist_catalog_serves_stale_while_refreshing():
+    listings = [["Kids"], ["Kids", "Dinner"]]
+    refreshing = asyncio.Event()
+
+    async def get_playlists():
+        titles = listings.pop(0)
+        if not listings:
+            await refreshing.wait()
+        return [SimpleNamespace(title=title) for title in titles]
+
+    catalog = PlaylistCatalog(get_playlists, refresh_interval=0)
+    assert (await catalog.find("kids")).title == "Kids"
+
+    # stale, but the playlist is known so the refresh isn't waited for
+    assert (await catalog.find("KIDS")).title == "Kids"
+    # a new playlist may be in the refresh so it's waited for
+    find = asyncio.create_task(catalog.find("dinner"))
+    await asyncio.sleep(0.01)
+    assert not find.done()
+    refreshing.set()
+    assert (await find).title == "Dinner"
+    await catalog.clean_up()
+
+
+def _playlist_device():
+    device = SimpleNamespace(calls=[], update_id=1)
+    device.play = device.pause = device.play_from_queue = lambda *_: None
+    device.clear_queue = lambda: device.calls.append("clear")
+    device.add_to_queue = lambda p: device.calls.append(p.title)
+    device.get_queue = lambda max_items: SimpleNamespace(
+        update_id=device.update_id
+    )
+    return device
+
+
+@pytest.mark.asyncio
+async def test_playlist_only_reloaded_once_the_queue_has_changed():
+    device = _playlist_device()
+
+    async def get_playlists():
+        return [SimpleNamespace(title="Kid's Room", item_id="SQ:1")]
+
+    playback = PlaybackController(
+        device, None, None,
+        queued_executors.SingleFlightThreadExecutor(),
+        None,
+        PlaylistCatalog(get_playlists),
+    )
+    # the name comes from the page's query string
+    playback.request_playlist("kid%27s%20room")
+    await playback._playlist_load
+    # e.g. the page being reloaded
+    await playback.load_playlist("kid's room")
+    assert device.calls == ["clear", "Kid's Room"]
+
+    device.update_id = 2
+    await playback.load_playlist("kid's room")
+    assert device.calls == ["clear", "Kid's Room"] * 2
@@ -0,0 +1,252 @@
+
+import asyncio
+import json
+import sys
+
+import pytest
+
+import sonos
+from snapshots import QueueSnapshots
+from sonos import QueueItem, QueuePage, SonosQueueState
+
+
+def _queue_item(position, title="title"):
+    return QueueItem(
+        title, "album", "artist", "sonos_uri", position, "cache/a.png", True
+    )
+
+
+def _queue_state(queue, messages, pages_fetched=None):
+    async def get_queue_page(start, max_items):
+        if pages_fetched is not None:
+            pages_fetched.append((start, max_items))
+        return QueuePage(start, len(queue), queue[start:start + max_items])
+
+    return SonosQueueState(
+        get_queue_page,
+        lambda art, callback: None,
+        messages.append,
+    )
+
+
+@pytest.mark.asyncio
+async def test_transport_only_sent_when_queue_unchanged():
+    """A change in the transport state shouldn't resend the queue"""
+    messages = []
+    queue = [_queue_item(0), _queue_item(1)]
+    queue_state = _queue_state(queue, messages)
+
+    queue_state.callback_sonos_event(True, "PLAYING", 0)
+    await asyncio.sleep(0.01)
+    assert [m["type"] for m in messages] == [
+        "transport", "queue_chunk", "transport"
+    ]
+    assert messages[-1]["queue_version"] == 1
+
+    messages.clear()
+    queue_state.callback_sonos_event(True, "PAUSED_PLAYBACK", 1)
+    await asyncio.sleep(0.01)
+    assert [m["type"] for m in messages] == ["transport"]
+    assert messages[0]["current_track"] == 1
+    assert messages[0]["queue_version"] == 1
+
+
+@pytest.mark.asyncio
+async def test_queue_version_bumped_when_queue_changes():
+    messages = []
+    queue = [_queue_item(0)]
+    queue_state = _queue_state(queue, messages)
+    queue_state.callback_sonos_event(True, "PLAYING", 0)
+    await asyncio.sleep(0.01)
+
+    queue.append(_queue_item(1))
+    messages.clear()
+    queue_state.callback_sonos_event(True, "PLAYING", 0)
+    await asyncio.sleep(0.01)
+    assert [m["type"] for m in messages] == [
+        "transport", "queue_chunk", "transport"
+    ]
+    assert messages[1]["queue_version"] == 2
+    assert len(messages[1]["data"]) == 2
+
+
+@pytest.mark.asyncio
+async def test_new_client_waits_for_first_queue():
+    messages = []
+    queue_state = _queue_state([_queue_item(0)], messages)
+
+    queue_message, transport_message = await queue_state.get_messages()
+    assert queue_message["queue_version"] == 1
+    assert len(queue_message["data"]) == 1
+    assert transport_message["queue_version"] == 1
+
+
+@pytest.mark.asyncio
+async def test_queue_streamed_from_current_track(monkeypatch):
+    monkeypatch.setattr(sonos, "QUEUE_FIRST_CHUNK_SIZE", 4)
+    monkeypatch.setattr(sonos, "QUEUE_CHUNK_SIZE", 3)
+    messages = []
+    pages_fetched = []
+    queue = [_queue_item(i) for i in range(10)]
+    queue_state = _queue_state(queue, messages, pages_fetched)
+
+    queue_state.callback_sonos_event(True, "PLAYING", 5)
+    await asyncio.sleep(0.01)
+
+    assert pages_fetched == [(3, 4), (7, 3), (0, 3)]
+    chunks = [m for m in messages if m["type"] == "queue_chunk"]
+    assert [(c["start"], len(c["data"])) for c in chunks] == [
+        (3, 4), (7, 3), (0, 3)
+    ]
+    queue_message, _ = await queue_state.get_messages()
+    assert [item["position"] for item in queue_message["data"]] == list(
+        range(10)
+    )
+
+
+@pytest.mark.asyncio
+async def test_chunks_only_sent_once_a_page_differs(monkeypatch):
+    monkeypatch.setattr(sonos, "QUEUE_FIRST_CHUNK_SIZE", 2)
+    monkeypatch.setattr(sonos, "QUEUE_CHUNK_SIZE", 2)
+    messages = []
+    queue = [_queue_item(i) for i in range(6)]
+    queue_state = _queue_state(queue, messages)
+    queue_state.callback_sonos_event(True, "PLAYING", 0)
+    await asyncio.sleep(0.01)
+
+    queue[4] = _queue_item(4, title="changed")
+    messages.clear()
+    queue_state.callback_sonos_event(True, "PLAYING", 0)
+    await asyncio.sleep(0.01)
+
+    chunks = [m for m in messages if m["type"] == "queue_chunk"]
+    # the unchanged pages fetched before the change are sent as well
+    assert [c["start"] for c in chunks] == [0, 2, 4]
+    assert {c["queue_version"] for c in chunks} == {2}
+
+
+@pytest.mark.asyncio
+async def test_snapshot_served_then_revalidated(tmp_path):
+    snapshots = QueueSnapshots(str(tmp_path))
+    queue = [_queue_item(i) for i in range(3)]
+    await snapshots.save("Living Room", "7", queue)
+
+    queue_item = lambda position, title, album, artist, sonos_art_uri: \
+        QueueItem(
+            title, album, artist, sonos_art_uri, position, "cache/a.png", True
+        )
+    snapshot = snapshots.load("Living Room", queue_item)
+    assert snapshot.update_id == "7"
+    assert snapshot.items == queue
+
+    messages = []
+    pages_fetched = []
+    queue_state = _queue_state(queue, messages, pages_fetched)
+    queue_state._load_snapshot(snapshot)
+
+    queue_message, _ = await queue_state.get_messages()
+    assert len(queue_message["data"]) == 3
+    assert pages_fetched == []
+
+    # same update id as the snapshot so nothing is refetched
+    queue_state.callback_queue_changed("7")
+    queue_state.callback_sonos_event(False, "PLAYING", 0)
+    await asyncio.sleep(0.01)
+    assert pages_fetched == []
+    assert [m["type"] for m in messages] == ["transport"]
+
+
+@pytest.mark.asyncio
+async def test_art_ready_batched(monkeypatch):
+    monkeypatch.setattr(sonos, "ART_READY_WINDOW", 0.01)
+    messages = []
+    queue = [
+        QueueItem("t", "a", "b", "s", i, f"cache/{i % 2}", False)
+        for i in range(4)
+    ]
+    queue_state = _queue_state(queue, messages)
+    await queue_state.get_messages()
+    messages.clear()
+
+    queue_state.callback_art_downloaded("cache/0")
+    queue_state.callback_art_downloaded("cache/1")
+    await asyncio.sleep(0.02)
+
+    assert [m["type"] for m in messages] == ["art_ready"]
+    assert messages[0]["server_art_uris"] == ["cache/0", "cache/1"]
+    queue_message, _ = await queue_state.get_messages()
+    assert all(item["art_available"] for item in queue_message["data"])
+
+
+@pytest.mark.asyncio
+async def test_command_shown_then_confirmed_or_rolled_back(monkeypatch):
+    monkeypatch.setattr(sonos, "OPTIMISTIC_TIMEOUT", 0.01)
+    messages = []
+    queue_state = _queue_state([_queue_item(0), _queue_item(1)], messages)
+    queue_state.callback_sonos_event(False, "PAUSED_PLAYBACK", 0)
+    await asyncio.sleep(0.01)
+
+    messages.clear()
+    queue_state.callback_command("play_index", (1,), "1")
+    queue_state.callback_sonos_event(False, "TRANSITIONING", 0)
+    queue_state.callback_sonos_event(False, "PLAYING", 1)
+    assert [
+        (m["state"], m["current_track"], m["optimistic"], m["confirmed"])
+        for m in messages
+    ] == [
+        ("PLAYING", 1, True, None),
+        ("PLAYING", 1, True, None),
+        ("PLAYING", 1, False, True),
+    ]
+    assert {m["command_id"] for m in messages} == {"1"}
+
+    # the speaker never follows the command
+    messages.clear()
+    queue_state.callback_command("pause", (), "2")
+    await asyncio.sleep(0.05)
+    assert [(m["state"], m["confirmed"]) for m in messages] == [
+        ("PAUSED_PLAYBACK", None), ("PLAYING", False)
+    ]
+    assert messages[-1]["command_id"] == "2"
+
+    # a second command before the first is confirmed
+    messages.clear()
+    queue_state.callback_command("play", (), "3")
+    queue_state.callback_command("pause", (), "4")
+    assert [
+        (m["command_id"], m["optimistic"], m["confirmed"], m["superseded"])
+        for m in messages
+    ] == [
+        ("3", True, None, False),
+        ("3", False, False, True),
+        ("4", True, None, False),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_queue_message_encoded_once_until_art_changes():
+    messages = []
+    queue_state = _queue_state(
+        [_queue_item(0, "Hey Jude"), _queue_item(1, "Let It Be")], messages
+    )
+    first, _ = await queue_state.get_messages()
+    second, _ = await queue_state.get_messages()
+    assert first is second
+    assert json.loads(first.encoded())["data"][1]["title"] == "Let It Be"
+
+    queue_state._queue[0].art_available = False
+    queue_state.callback_art_downloaded("cache/a.png")
+    third, _ = await queue_state.get_messages()
+    assert third is not first
+    assert third["data"][0]["art_available"]
+
+
+def test_queue_items_compared_by_value_and_share_names():
+    album = "".join(["Abbey", " Road"])
+    item = QueueItem("Something", album, "Beatles", "uri", 1, "cache/b", False)
+    assert item.album is sys.intern("Abbey Road")
+    assert item == QueueItem(
+        "Something", "Abbey Road", "Beatles", "uri", 1, "cache/b", False
+    )
+    assert item != _queue_item(1)
+    assert not hasattr(item, "__dict__")
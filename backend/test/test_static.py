@@ -0,0 +1,42 @@
+
+import gzip
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+import pytest
+
+from static import IMMUTABLE, REVALIDATE, StaticFiles
+
+
+@pytest.mark.asyncio
+async def test_static_files_cached_and_precompressed(tmp_path):
+    script = b"console.log('hello');" * 100
+    (tmp_path / "static").mkdir()
+    (tmp_path / "static" / "main.8a4f2d1c.chunk.js").write_bytes(script)
+    (tmp_path / "manifest.json").write_bytes(b"{}")
+
+    build_files = StaticFiles(str(tmp_path))
+    assert (tmp_path / "static" / "main.8a4f2d1c.chunk.js.gz").is_file()
+
+    app = web.Application()
+    app.router.add_get('/{filename:.+}', build_files.handler)
+    async with TestClient(TestServer(app)) as client:
+        response = await client.get(
+            "/static/main.8a4f2d1c.chunk.js",
+            headers={"Accept-Encoding": "gzip"},
+            auto_decompress=False,
+        )
+        assert response.headers["Cache-Control"] == IMMUTABLE
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(await response.read()) == script
+
+        response = await client.get("/manifest.json")
+        assert response.headers["Cache-Control"] == REVALIDATE
+        etag = response.headers["ETag"]
+        response = await client.get(
+            "/manifest.json", headers={"If-None-Match": etag}
+        )
+        assert response.status == 304
+
+        response = await client.get("/missing.js")
+        assert response.status == 404
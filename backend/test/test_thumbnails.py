@@ -0,0 +1,46 @@
+
+import pytest
+
+import thumbnails
+
+
+@pytest.mark.asyncio
+async def test_smallest_thumbnail_that_fits_served(tmp_path):
+    Image = pytest.importorskip("PIL.Image")
+    art = tmp_path / "artist___album.png"
+    Image.new("RGB", (300, 300), "red").save(art, "PNG")
+
+    thumbs = thumbnails.Thumbnails(
+        str(tmp_path / "thumbs"), sizes=(192, 96, 384), processes=1
+    )
+    await thumbs.make(str(art))
+    await thumbs.clean_up()
+
+    # art isn't scaled up so there's no 384px thumbnail
+    assert thumbs.variant(str(art), 80).endswith("artist___album_96.webp")
+    assert thumbs.variant(str(art), 100).endswith("artist___album_192.webp")
+    assert thumbs.variant(str(art), 250) == str(art)
+
+    # found on disk after a restart
+    restarted = thumbnails.Thumbnails(
+        str(tmp_path / "thumbs"), sizes=(96, 192, 384), processes=1
+    )
+    assert restarted.variant(str(art), 100) == thumbs.variant(str(art), 100)
+    await restarted.clean_up()
+
+
+def test_original_served_and_nothing_removed_without_pillow(
+    monkeypatch, tmp_path
+):
+    # as if Pillow wasn't installed
+    monkeypatch.setattr(thumbnails, "Image", None)
+    monkeypatch.delattr(thumbnails, "features", raising=False)
+    thumbnails._thumbnail_format.cache_clear()
+
+    thumbs = thumbnails.Thumbnails(str(tmp_path / "thumbs"))
+    art = str(tmp_path / "artist___album.png")
+    assert not thumbs.enabled
+    assert thumbs.variant(art, 100) == art
+    # called by the art index when art is evicted
+    thumbs.remove(art)
+    thumbs.remove_orphans({art})
@@ -0,0 +1,67 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from events import SocoEventHandler
+from playback import PlaybackController
+from queued_executors import LastInQueuedThreadExecutor
+import tracing
+
+
+@pytest.fixture
+def ring():
+    ring = tracing.RingSink()
+    tracing.enable(ring)
+    yield ring
+    tracing.disable()
+
+
+@pytest.mark.asyncio
+async def test_command_traced_to_device_call(ring):
+    device = SimpleNamespace(
+        play=lambda: None, play_from_queue=None, pause=None
+    )
+    queue = LastInQueuedThreadExecutor()
+    playback = PlaybackController(device, queue, queue, None, None, None)
+    sent = []
+    playback.callback_command = lambda *args: sent.append(tracing.current())
+
+    await playback.parse_client_command(
+        json.dumps({"command": "play", "args": []})
+    )
+    await queue._queue.join()
+    queue._task.cancel()
+
+    trace_id = sent[0]
+    assert trace_id.startswith("command-")
+    assert [s["span"] for s in ring.spans if s["trace"] == trace_id] == [
+        "command.parse", "command.queue_wait", "command.device_call"
+    ]
+    assert tracing.current() is None
+
+
+@pytest.mark.asyncio
+async def test_event_burst_traced_and_off_by_default(ring):
+    traces = []
+    handler = SocoEventHandler(
+        SimpleNamespace(),
+        lambda *args: traces.append(tracing.current()),
+        lambda: True,
+        quiet_window=0.001,
+    )
+    event = SimpleNamespace(
+        variables={"transport_state": "PLAYING", "current_track": "1"}
+    )
+    handler._callback(event)
+    handler._callback(event)
+    await asyncio.sleep(0.01)
+    assert [s["span"] for s in ring.spans] == ["event.burst"]
+    assert traces == [ring.spans[0]["trace"]]
+
+    tracing.disable()
+    handler._callback(event)
+    await asyncio.sleep(0.01)
+    assert traces[-1] is None
+    assert len(ring.spans) == 1
@@ -0,0 +1,78 @@
+
+import os
+from types import SimpleNamespace
+
+from aiohttp.test_utils import make_mocked_request
+import pytest
+from aiohttp import web
+
+from art_index import ArtIndex
+import views
+
+
+class FakeControllers(dict):
+    @property
+    def paths(self):
+        return set(self)
+
+
+def test_index_pages_rendered_once_and_refreshed(tmp_path, monkeypatch):
+    index_html = tmp_path / "index.html"
+    index_html.write_text("<title>$TITLE</title>")
+    living_room = SimpleNamespace(name="Living Room")
+    controllers = FakeControllers(
+        {"/Living Room": living_room, "/livingroom": living_room}
+    )
+    index_pages = views.IndexPages(controllers, str(index_html))
+
+    response = index_pages.response(make_mocked_request("GET", "/livingroom"))
+    assert response.body == b"<title>Living Room</title>"
+    etag = response.headers["ETag"]
+
+    response = index_pages.response(make_mocked_request(
+        "GET", "/livingroom", headers={"If-None-Match": etag}
+    ))
+    assert response.status == 304
+
+    index_html.write_text("<h1>$TITLE</h1>")
+    os.utime(index_html, ns=(0, 0))
+    monkeypatch.setattr(views, "INDEX_CHECK_INTERVAL", -1)
+    response = index_pages.response(make_mocked_request("GET", "/livingroom"))
+    assert response.body == b"<h1>Living Room</h1>"
+    assert response.headers["ETag"] != etag
+
+    with pytest.raises(web.HTTPNotFound):
+        index_pages.response(make_mocked_request("GET", "/kitchen"))
+
+
+@pytest.mark.asyncio
+async def test_art_revalidated_against_the_image_hash(tmp_path):
+    art_index = ArtIndex(str(tmp_path))
+    temp_path = tmp_path / "download.part"
+    temp_path.write_bytes(b"\x89PNG first")
+    art_index.add("cache/album", str(temp_path), "1")
+    controllers = FakeControllers()
+    # no thumbnails, e.g. without Pillow
+    controllers.art_index = art_index
+    controllers.thumbnails = SimpleNamespace(variant=lambda path, w: path)
+    app = {"controllers": controllers}
+
+    def request(headers=None):
+        return make_mocked_request(
+            "GET", "/cache/album?w=96", headers=headers, app=app,
+            match_info={"name": "album"},
+        )
+
+    response = await views.art(request())
+    assert response.body == b"\x89PNG first"
+    assert response.content_type == "image/png"
+    assert response.headers["Cache-Control"] == "no-cache"
+    etag = response.headers["ETag"]
+    response = await views.art(request({"If-None-Match": etag}))
+    assert response.status == 304
+
+    # downloaded again after being evicted
+    temp_path.write_bytes(b"\x89PNG second")
+    art_index.add("cache/album", str(temp_path), "2")
+    response = await views.art(request({"If-None-Match": etag}))
+    assert response.body == b"\x89PNG second"
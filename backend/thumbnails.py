@@ -0,0 +1,143 @@
+"""Make small versions of the album art for the clients
+
+The art from the sonos is often 500-1000px while the clients only show
+small squares. Decoding and resizing is cpu heavy so it's done in a
+separate process. Pillow is optional, without it the original art is
+always served.
+"""
+
+from __future__ import annotations
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import os
+from typing import TYPE_CHECKING
+
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = None
+
+
+if TYPE_CHECKING:
+    from typing import Optional
+
+
+THUMBNAIL_FOLDER = "cache/thumbs"
+THUMBNAIL_SIZES = (96, 192, 384)
+THUMBNAIL_PROCESSES = 2
+
+
+@lru_cache(maxsize=None)
+def _thumbnail_format() -> tuple[str, str]:
+    if features.check("webp"):
+        return "WEBP", "webp"
+    return "JPEG", "jpg"
+
+
+def thumbnail_path(folder: str, path: str, size: int) -> str:
+    stem = os.path.splitext(os.path.basename(path))[0]
+    _, extension = _thumbnail_format()
+    return os.path.join(folder, f"{stem}_{size}.{extension}")
+
+
+def make_thumbnails(
+    path: str,
+    folder: str,
+    sizes: tuple[int, ...],
+) -> tuple[int, ...]:
+    """Runs in a worker process, returns the sizes made. Art is never
+    scaled up so small originals may not get every size
+    """
+    image_format, _ = _thumbnail_format()
+    made = []
+    with Image.open(path) as image:
+        image = image.convert("RGBA" if image_format == "WEBP" else "RGB")
+        for size in sizes:
+            if size >= max(image.size):
+                break
+            thumbnail = image.copy()
+            thumbnail.thumbnail((size, size))
+            thumbnail.save(
+                thumbnail_path(folder, path, size), image_format, quality=80
+            )
+            made.append(size)
+    return tuple(made)
+
+
+class Thumbnails:
+    """Keeps track of the thumbnails available for each piece of art so
+    the smallest one that fits the client can be served
+    """
+
+    def __init__(
+        self,
+        folder: str = THUMBNAIL_FOLDER,
+        sizes: tuple[int, ...] = THUMBNAIL_SIZES,
+        processes: int = THUMBNAIL_PROCESSES,
+    ) -> None:
+
+        self.enabled = Image is not None
+        self._folder = folder
+        self._sizes = tuple(sorted(sizes))
+        self._available: dict[str, tuple[int, ...]] = {}
+        self._executor: Optional[ProcessPoolExecutor] = None
+        if self.enabled:
+            os.makedirs(folder, exist_ok=True)
+            self._executor = ProcessPoolExecutor(processes)
+
+    async def clean_up(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    async def make(self, path: str) -> None:
+        """Post download stage for the art downloader"""
+        if not self.enabled:
+            return
+        loop = asyncio.get_event_loop()
+        try:
+            sizes = await loop.run_in_executor(
+                self._executor, make_thumbnails, path, self._folder,
+                self._sizes,
+            )
+        except Exception as e:
+            # not an image Pillow can read, the original is served
+            print("failed to make thumbnails: ", path, repr(e))
+            return
+        self._available[path] = sizes
+
+    def remove(self, path: str) -> None:
+        """Removes the thumbnails for art that's been removed"""
+        if not self.enabled:
+            return
+        for size in self._available.pop(path, self._sizes):
+            thumbnail = thumbnail_path(self._folder, path, size)
+            if os.path.isfile(thumbnail):
+                os.remove(thumbnail)
+
+    def remove_orphans(self, paths: set[str]) -> None:
+        """Removes thumbnails for art that's no longer stored"""
+        if not self.enabled:
+            return
+        stems = {os.path.splitext(os.path.basename(p))[0] for p in paths}
+        for entry in os.scandir(self._folder):
+            if entry.name.rsplit("_", 1)[0] not in stems:
+                os.remove(entry.path)
+
+    def _sizes_on_disk(self, path: str) -> tuple[int, ...]:
+        return tuple(
+            size for size in self._sizes
+            if os.path.isfile(thumbnail_path(self._folder, path, size))
+        )
+
+    def variant(self, path: str, width: int) -> str:
+        """The smallest thumbnail at least width wide, or the original"""
+        if not self.enabled:
+            return path
+        if path not in self._available:
+            # art downloaded before the server was restarted
+            self._available[path] = self._sizes_on_disk(path)
+        for size in self._available[path]:
+            if size >= width:
+                return thumbnail_path(self._folder, path, size)
+        return path
@@ -0,0 +1,168 @@
+"""Opt-in tracing of client commands and speaker events
+
+Each command and each burst of events is given an id and timed spans
+are recorded as it passes through the server, e.g. waiting in the
+command queue, the soco call, refetching the queue and sending to the
+websockets. Spans are written as json lines to a rotating file or held
+in memory and served at /trace. Tracing is off unless the SONOS_TRACE
+environment variable is set to "ring" or to a file path.
+
+The id is carried in a context variable so it follows a command into
+callbacks and the tasks they start. Code running in a worker thread is
+given the id explicitly.
+"""
+
+from __future__ import annotations
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from itertools import count
+import json
+import logging
+from logging.handlers import RotatingFileHandler
+import os
+import time
+from typing import TYPE_CHECKING
+
+
+if TYPE_CHECKING:
+    from typing import Callable, Iterator, Optional
+
+
+TRACE_VARIABLE = "SONOS_TRACE"
+RING_SIZE = 10000
+# bytes per file and files kept
+FILE_SIZE = 10 * 1024 * 1024
+FILE_BACKUPS = 3
+
+_current: ContextVar[Optional[str]] = ContextVar("trace_id", default=None)
+_ids = count(1)
+
+
+class RingSink:
+    """Keeps the latest spans in memory"""
+
+    def __init__(self, size: int = RING_SIZE) -> None:
+        self.spans: deque[dict] = deque(maxlen=size)
+
+    def write(self, span: dict) -> None:
+        self.spans.append(span)
+
+
+class FileSink:
+    """Writes spans as json lines to a rotating file"""
+
+    def __init__(
+        self,
+        path: str,
+        size: int = FILE_SIZE,
+        backups: int = FILE_BACKUPS,
+    ) -> None:
+
+        self._logger = logging.getLogger("sonos.tracing")
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        self._logger.addHandler(
+            RotatingFileHandler(path, maxBytes=size, backupCount=backups)
+        )
+
+    def write(self, span: dict) -> None:
+        self._logger.info(json.dumps(span, separators=(",", ":")))
+
+
+_sink: Optional[RingSink | FileSink] = None
+
+
+def enable(sink: RingSink | FileSink) -> None:
+    global _sink
+    _sink = sink
+
+
+def disable() -> None:
+    global _sink
+    _sink = None
+
+
+def enable_from_environment() -> None:
+    setting = os.environ.get(TRACE_VARIABLE)
+    if not setting:
+        return
+    enable(RingSink() if setting == "ring" else FileSink(setting))
+    print("tracing to: ", setting)
+
+
+def ring() -> Optional[RingSink]:
+    return _sink if isinstance(_sink, RingSink) else None
+
+
+def new_id(kind: str) -> Optional[str]:
+    """None while tracing is off, so nothing downstream is recorded"""
+    if _sink is None:
+        return None
+    return f"{kind}-{next(_ids)}"
+
+
+def current() -> Optional[str]:
+    return _current.get()
+
+
+@contextmanager
+def trace(trace_id: Optional[str]) -> Iterator[Optional[str]]:
+    """Makes trace_id the current id for the code in the block"""
+    token = _current.set(trace_id)
+    try:
+        yield trace_id
+    finally:
+        _current.reset(token)
+
+
+def record(
+    name: str,
+    trace_id: Optional[str],
+    started: float,
+    **attributes,
+) -> None:
+    """Records a span that started at time.monotonic() started and ends
+    now, for spans that cross callbacks
+    """
+    if _sink is None or trace_id is None:
+        return
+    duration = time.monotonic() - started
+    _sink.write({
+        "trace": trace_id,
+        "span": name,
+        "start": round(time.time() - duration, 6),
+        "ms": round(duration * 1000, 3),
+        **attributes,
+    })
+
+
+@contextmanager
+def span(
+    name: str,
+    trace_id: Optional[str] = None,
+    **attributes,
+) -> Iterator[None]:
+    """Times the block, uses the current id if none is given"""
+    if trace_id is None:
+        trace_id = _current.get()
+    if _sink is None or trace_id is None:
+        yield
+        return
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        record(name, trace_id, started, **attributes)
+
+
+def traced(name: str) -> Callable[[Callable], Callable]:
+    """Decorator that records a span for each call of a function"""
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
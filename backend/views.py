@@ -3,46 +3,193 @@ through websockets
 """ 
 
 from __future__ import annotations
+import asyncio
+import hashlib
+import mimetypes
+import os
 from string import Template
+import time
 from typing import TYPE_CHECKING
 
 
 import aiohttp
 from aiohttp import web
 
+import encoding
+import metrics
+import tracing
+from static import REVALIDATE
+
 
 if TYPE_CHECKING:
-    from controller import Controller
+    from typing import Optional
+    from controller import Controller, Controllers
 
 
-def _html_response(name: str) -> web.Response:
-    with open("../frontend/build/index.html", "r") as f:
-       template = Template(f.read())
-    return web.Response(
-        text=template.substitute(TITLE=name),
-        content_type='text/html'
-    )
+INDEX_HTML = "../frontend/build/index.html"
+# whether permessage-deflate is offered to clients, this is aiohttp's
+# default. The queue messages repeat the album details for each track so
+# they compress well, False saves the cpu e.g. on a raspberry pi
+WEBSOCKET_COMPRESS = True
+# how often to check whether the build has changed, seconds
+INDEX_CHECK_INTERVAL = 1
+
+
+class IndexPages:
+    """The index page rendered for each speaker path, rendered again if 
+    the build changes
+    """
+
+    def __init__(self, controllers: Controllers, path: str = INDEX_HTML):
+        self._controllers = controllers
+        self._path = path
+        self._mtime: Optional[int] = None
+        self._checked: float = 0
+        self._template: Optional[Template] = None
+        # speaker name -> (html, etag)
+        self._pages: dict[str, tuple[bytes, str]] = {}
+        self._check_build()
+
+    def _check_build(self) -> None:
+        self._checked = time.monotonic()
+        try:
+            mtime = os.stat(self._path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != self._mtime:
+            self._mtime = mtime
+            self._load_template()
+
+    def _load_template(self) -> None:
+        self._pages = {}
+        self._template = None
+        if self._mtime is None:
+            return
+        with open(self._path, "r") as f:
+            self._template = Template(f.read())
+
+    def _page(self, name: str) -> tuple[bytes, str]:
+        """Rendered the first time it's asked for, speakers can be added
+        while the server is running
+        """
+        if name not in self._pages:
+            html = self._template.substitute(TITLE=name).encode("utf-8")
+            etag = '"' + hashlib.sha1(html).hexdigest()[:16] + '"'
+            self._pages[name] = html, etag
+        return self._pages[name]
+
+    def response(self, request: web.Request) -> web.Response:
+        if time.monotonic() - self._checked > INDEX_CHECK_INTERVAL:
+            self._check_build()
+        controller = self._controllers.get(request.path)
+        if controller is None or self._template is None:
+            raise web.HTTPNotFound()
+
+        html, etag = self._page(controller.name)
+        headers = {"ETag": etag, "Cache-Control": REVALIDATE}
+        if etag in request.headers.get("If-None-Match", ""):
+            return web.Response(status=304, headers=headers)
+        return web.Response(
+            body=html, content_type='text/html', headers=headers
+        )
+
+
+async def index_or_build_file(request):
+    """Speaker pages are checked first, then the react build"""
+    if request.path in request.app['controllers'].paths:
+        return await index(request)
+    return await request.app['build_files'].handler(request)
 
 
 async def index(request):
     controller: Controller = request.app['controllers'][request.path]
-    controller.playback.load_playlist(request.query_string)
+    controller.playback.request_playlist(request.query_string)
 
-    websocket = web.WebSocketResponse()
+    websocket = web.WebSocketResponse(
+        compress=WEBSOCKET_COMPRESS, protocols=tuple(encoding.SUBPROTOCOLS)
+    )
     if not websocket.can_prepare(request).ok:
-        return _html_response(controller.name)
+        return request.app['index_pages'].response(request)
 
     await websocket.prepare(request)
     
-    controller.websockets.add(websocket)
-    controller.websockets.send_queue(controller.queue_state.get_queue_dict())
+    client_id = controller.websockets.add(websocket)
+    controller.websockets.send_messages_to(
+        websocket, await controller.queue_state.get_messages()
+    )
     
     async for msg in websocket:
         print(msg)
         if msg.type != aiohttp.WSMsgType.text:
             break
-        await controller.playback.parse_client_command(msg.data)
+        await controller.playback.parse_client_command(
+            msg.data, client_id
+        )
 
     controller.websockets.remove(websocket)
 
-    return websocket
\ No newline at end of file
+    return websocket
+
+
+def _read_art(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+async def art(request):
+    """Serves album art, a w query parameter asks for the smallest 
+    thumbnail that is at least that many pixels wide
+    """
+    controllers: Controllers = request.app['controllers']
+    path = controllers.art_index.path(f"cache/{request.match_info['name']}")
+    metrics.ART_REQUESTS.inc(cached=str(path is not None).lower())
+    if path is None:
+        raise web.HTTPNotFound()
+
+    try:
+        width = int(request.query.get("w", 0))
+    except ValueError:
+        width = 0
+    if width > 0:
+        path = controllers.thumbnails.variant(path, width)
+    # the url is named after the album, the image behind it changes if
+    # it's evicted and downloaded again or a thumbnail is made. Images
+    # and their thumbnails are named by the hash of the image
+    etag = '"' + os.path.splitext(os.path.basename(path))[0] + '"'
+    headers = {"ETag": etag, "Cache-Control": REVALIDATE}
+    if etag in request.headers.get("If-None-Match", ""):
+        return web.Response(status=304, headers=headers)
+    loop = asyncio.get_event_loop()
+    try:
+        body = await loop.run_in_executor(None, _read_art, path)
+    except OSError:
+        # evicted since it was looked up
+        raise web.HTTPNotFound()
+    return web.Response(
+        body=body,
+        content_type=mimetypes.guess_type(path)[0] 
+            or "application/octet-stream",
+        headers=headers,
+    )
+
+
+async def metrics_page(request):
+    """Prometheus text format"""
+    return web.Response(
+        text=metrics.render(request.app['controllers']),
+        headers={"Content-Type": metrics.CONTENT_TYPE},
+    )
+
+
+async def trace_page(request):
+    """The spans held in memory when tracing to the ring, a trace query
+    parameter picks the spans for one command or event
+    """
+    ring = tracing.ring()
+    if ring is None:
+        raise web.HTTPNotFound()
+    trace_id = request.query.get("trace")
+    return web.json_response([
+        span for span in list(ring.spans)
+        if trace_id is None or span["trace"] == trace_id
+    ])
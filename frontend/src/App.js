@@ -3,6 +3,15 @@ import React from 'react';
 import loading from './loading.gif'
 import socketIOClient from "socket.io-client";
 
+// must match PROTOCOL_VERSION in backend/sonos.py
+const PROTOCOL_VERSION = 3;
+
+// art is shown at 20% of the width up to 200px (see .art in App.css), the
+// server sends the smallest thumbnail that covers this
+const ART_WIDTH = Math.ceil(
+  Math.min(200, window.innerWidth * 0.2) * (window.devicePixelRatio || 1)
+);
+
 
 class Track extends React.Component {
   constructor(props) {
@@ -46,6 +55,14 @@ class Track extends React.Component {
   }
 }
 
+function LoadingTrack(props) {
+  return (
+    <div className="grid-container">
+      <img className="art" src={loading} alt=""></img>
+    </div>
+  )
+}
+
 function Footer(props) {
   return (
     <div className='footer'>
@@ -58,6 +75,29 @@ function Footer(props) {
   )
 }
 
+// the queue messages in the dictionary coded encoding list each album
+// once, the tracks refer to it by index (see backend/encoding.py)
+const QUEUE_SUBPROTOCOL = "sonos.dict.v1"
+
+function decodeQueue(json) {
+  if (json.tracks === undefined) {
+    return json
+  }
+  const data = json.tracks.map((track) => {
+    if (track === null) {
+      return null
+    }
+    const [index, title, position, art_available] = track
+    const [album, artist, sonos_art_uri, server_art_uri] = json.albums[index]
+    return {
+      title, album, artist, sonos_art_uri, position, server_art_uri,
+      art_available,
+    }
+  })
+  const {albums, tracks, ...message} = json
+  return {...message, data: data}
+}
+
 class WebSocketConnectionBase {
   constructor(parent) {
     this.parent = parent
@@ -65,11 +105,13 @@ class WebSocketConnectionBase {
   }
 
   onMessage(event) {
-    const json = JSON.parse(event.data);
+    const json = decodeQueue(JSON.parse(event.data));
     this.parent.updateState(json)
   }
   
   onWebSocketClose(event) {
+    // queue versions restart if the server does
+    this.parent.setState({queue_version: null})
     setTimeout(() => {this.openNewWebSocket()}, 5000);
   }
 
@@ -80,7 +122,7 @@ class WebSocketConnectionBase {
 
 class WebSocketConnection extends WebSocketConnectionBase {
   openNewWebSocket() {
-    const websocket = new WebSocket(this.getURI());
+    const websocket = new WebSocket(this.getURI(), [QUEUE_SUBPROTOCOL]);
     websocket.onmessage = (event) => {this.onMessage(event)};
     websocket.onopen = (event) => {console.log("socket opened")}
     websocket.onclose = (event) => {this.onWebSocketClose(event)};
@@ -123,6 +165,7 @@ class App extends React.Component {
 
     this.state = {
       playlist: [],
+      queue_version: null,
       current_index: null,
       state: null,
     }
@@ -137,18 +180,67 @@ class App extends React.Component {
   }
 
   updateState(json) {
-    const new_state = {
-      playlist: json.data,
-      current_index: json.current_track,
-      state: json.state === "TRANSITIONING" ? this.state.state: json.state
+    if (json.version !== PROTOCOL_VERSION) {
+      console.log("unsupported protocol version", json.version)
+      return
+    }
+    if (json.type === "queue") {
+      if (json.queue_version < this.state.queue_version) {
+        return
+      }
+      this.setState({
+        playlist: json.data,
+        queue_version: json.queue_version,
+      })
+    } else if (json.type === "queue_chunk") {
+      this.setState((state) => {
+        if (json.queue_version < state.queue_version) {
+          return null
+        }
+        // a chunk for a new queue version starts an empty queue, items 
+        // still to arrive are null
+        const playlist = json.queue_version === state.queue_version ?
+          state.playlist.slice() :
+          new Array(json.total).fill(null)
+        playlist.splice(json.start, json.data.length, ...json.data)
+        return {playlist: playlist, queue_version: json.queue_version}
+      })
+    } else if (json.type === "art_ready") {
+      const ready = new Set(json.server_art_uris)
+      this.setState((state) => ({
+        playlist: state.playlist.map((track) => (
+          track !== null && ready.has(track.server_art_uri) ?
+            {...track, art_available: true} :
+            track
+        ))
+      }))
+    } else if (json.type === "transport") {
+      // the queue message for a new queue_version is always sent first,
+      // a mismatch here means the queue is still on its way. Commands
+      // are shown straight away by the server too, the state the device
+      // actually reached is sent when the command is confirmed or has
+      // timed out
+      if (json.superseded) {
+        console.log("command superseded by a later one", json.command_id)
+      } else if (json.confirmed === false) {
+        console.log("command not confirmed by the speaker", json.command_id)
+      }
+      this.setState({
+        current_index: json.current_track,
+        state: json.state === "TRANSITIONING" ? this.state.state: json.state
+      })
     }
-    this.setState(new_state)
   }
 
   sendCommand(command, args=[]) {
+    // the server prefixes this id with one for the websocket, then tags
+    // the transport messages that confirm or roll back the command with
+    // it, only this tablet is sent those
+    this.commandCount = (this.commandCount || 0) + 1
     let message = {
       command: command,
       args: args,
+      id: this.commandCount.toString(),
     }
     this.websocket.sendCommand(message)
   }  
@@ -177,6 +269,9 @@ class App extends React.Component {
 
   render() {
     const tracks = this.state.playlist.map((track, idx) => {
+      if (track === null) {
+        return <LoadingTrack key={"loading" + idx.toString()} />
+      }
       const key = (
         track.position.toString()
         + track.title
@@ -191,7 +286,9 @@ class App extends React.Component {
           title = {track.title}
           album = {track.album}
           artist = {track.artist}
-          server_art_uri = {this.getServerPath() + track.server_art_uri}
+          server_art_uri = {
+            this.getServerPath() + track.server_art_uri + "?w=" + ART_WIDTH
+          }
           art_available = {track.art_available}
           current_track = {track.position === this.state.current_index}
           onClick = {(index) => this.play(0, index)}